@@ -1,5 +1,21 @@
-from django.conf import settings
+from search.connection import get_backend
 
-from elasticsearch import Elasticsearch
+default_app_config = 'search.apps.SearchConfig'
 
-es = Elasticsearch(settings.ELASTICSEARCH_NODES)
\ No newline at end of file
+
+class LazyBackend(object):
+    """
+    Stands in for the ES client of the current process, see search.connection
+    """
+    def __getattr__(self, name):
+        return getattr(get_backend(), name)
+
+es = LazyBackend()
+
+
+def msearch(sqs_list, start=0, end=None):
+    """
+    Runs many SQS in a single round trip, see search.models.msearch
+    """
+    from search.models import msearch
+    return msearch(sqs_list, start, end)
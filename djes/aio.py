@@ -0,0 +1,319 @@
+"""
+asyncio flavour of SQS. Needs Python 3.6+ and an asyncio ES client, either
+``elasticsearch`` 7.8+ with its async extra or the ``elasticsearch-async``
+package.
+"""
+from django.conf import settings
+
+from elasticsearch import NotFoundError
+
+from search.connection import client_options
+from search.models import SQS, prepare_msearch, get_msearch_body, get_msearch_index, set_msearch_response
+from search.query import Query
+from search import conf
+from search.instrumentation import measure
+
+try:
+    from elasticsearch import AsyncElasticsearch
+except ImportError:
+    try:
+        from elasticsearch_async import AsyncElasticsearch
+    except ImportError:
+        AsyncElasticsearch = None
+
+
+_async_es = None
+
+
+def get_async_backend():
+    """
+    Returns the asyncio ES client of this process, with its own connection pool
+    """
+    global _async_es
+
+    if _async_es is None:
+        if AsyncElasticsearch is None:
+            raise ImportError("AsyncSQS needs an asyncio Elasticsearch client, install elasticsearch-async")
+        _async_es = AsyncElasticsearch(settings.ELASTICSEARCH_NODES, **client_options(maxsize=conf.ASYNC_POOL_SIZE))
+
+    return _async_es
+
+
+class AsyncQuery(Query):
+    """
+    Query whose hits to ES are coroutines. Building the query DSL is shared
+    with Query, everything that talks to the backend has to be awaited
+    """
+    async def get_results(self):
+        if self._results is None:
+            if self.mlt_query:
+                await self.run_mlt()
+            else:
+                await self.run()
+
+        return self._results
+
+    async def get_count(self):
+        if self._hit_count is None:
+            await self.run_count()
+
+        return self._hit_count
+
+    async def get_facet_counts(self):
+        if self._facet_counts is None:
+            await self.run_facets()
+
+        return self._facet_counts
+
+    async def get_suggestions(self):
+        if self._suggestions is None:
+            await self.run()
+
+        return self._suggestions
+
+    async def search(self, body, params):
+        with measure("search", self.index, self.doc_type) as measurement:
+            results = self.get_cached_response(body, params)
+
+            if results is not None:
+                measurement.set_response(results, "hit")
+            else:
+                results = await self.backend.search(index=self.index, doc_type=self.doc_type, body=body, **params)
+                measurement.set_response(results, "miss" if self.get_cache() is not None else None)
+                results = self.cache_response(body, params, results)
+
+        return results
+
+    async def run(self):
+        final_query, params = self.prepare()
+        self.set_response(await self.search(final_query, params))
+
+    async def run_mlt(self):
+        body = self.build_query()
+
+        with measure("mlt", self.index, self.doc_type) as measurement:
+            results = await self.backend.mlt(body=body, **self.mlt_params(search_from=self.offset, search_size=self.size))
+            measurement.set_response(results)
+
+        self.set_response(results)
+
+    async def run_count(self):
+        body = self.count_body()
+
+        if self.mlt_query:
+            with measure("mlt", self.index, self.doc_type) as measurement:
+                results = await self.backend.mlt(body=body, **self.mlt_params(search_from=0, search_size=0))
+                measurement.set_response(results)
+        else:
+            results = await self.search(body, self.hit_free_params())
+
+        self._hit_count = results['hits']['total']
+
+    async def run_facets(self):
+        results = await self.search(self.facets_body(), self.hit_free_params(facets=True))
+
+        self._hit_count = results['hits']['total']
+        self._facet_counts = self.process_facets(results.get('facets', {}))
+
+    async def scan(self, chunk_size, scroll):
+        method, params = self.scan_request(chunk_size, scroll)
+        with measure("scan", self.index, self.doc_type) as measurement:
+            results = await getattr(self.backend, method)(**params)
+            measurement.set_response(results)
+
+        scroll_id = results.get('_scroll_id')
+
+        try:
+            while results['hits']['hits']:
+                yield results['hits']['hits']
+                with measure("scroll", self.index, self.doc_type) as measurement:
+                    results = await self.backend.scroll(scroll_id=scroll_id, scroll=scroll)
+                    measurement.set_response(results)
+                scroll_id = results.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id is not None:
+                try:
+                    await self.backend.clear_scroll(scroll_id=scroll_id)
+                except Exception:
+                    # Scroll contexts expire on their own after the timeout
+                    pass
+
+
+async def msearch(sqs_list, start=0, end=None):
+    """
+    Runs many AsyncSQS in a single round trip, see search.models.msearch
+    """
+    pending = prepare_msearch(sqs_list, start, end)
+
+    if pending:
+        request = get_msearch_body(pending)
+        with measure("msearch", get_msearch_index(pending)) as measurement:
+            response = await pending[0][0].backend.msearch(body=request)
+            measurement.set_response(response)
+
+        set_msearch_response(pending, start, response)
+
+    return sqs_list
+
+
+class AsyncSQS(SQS):
+    """
+    Search Queryset for asyncio code. Chaining works exactly like SQS, results
+    are read with awaitable methods instead of slicing, len() and iteration.
+    Writes and loading models, which would block the event loop, stay with SQS
+    """
+    query_class = AsyncQuery
+    is_async = True
+
+    def get_default_backend(self):
+        return get_async_backend()
+
+    def __repr__(self):
+        return "<AsyncSQS: %s.%s>" % (self.index_name, self.doc_type)
+
+    def __len__(self):
+        raise TypeError("AsyncSQS has no len(), use 'await sqs.count()'")
+
+    def __iter__(self):
+        raise TypeError("AsyncSQS is not iterable, use 'await sqs.fetch()' or 'async for result in sqs.scan()'")
+
+    def __getitem__(self, k):
+        raise TypeError("AsyncSQS can not be sliced, use 'await sqs.fetch(start, end)'")
+
+    async def fetch(self, start=0, end=None):
+        """
+        Returns results from start up to end, from the result cache where possible
+        """
+        if end is None:
+            end = start + conf.SIZE_PER_QUERY
+
+        if self._result_count is not None:
+            end = min(end, self._result_count)
+
+        if not self._result_cache.is_cached(start, end):
+            self.query._reset()
+            self.query.set_limits(start, end)
+            results = await self.query.get_results()
+            self._result_count = self.query._hit_count
+
+            if results:
+                self._result_cache.add(start, self.post_process_results(results))
+
+        return self._result_cache.slice(start, end)
+
+    async def count(self):
+        """
+        Return count of results for the query, using a count only query
+        """
+        if self._result_count is None:
+            self._result_count = await self.query.get_count()
+
+        return self._result_count
+
+    async def facet_counts(self):
+        return await self.query.get_facet_counts()
+
+    async def get_suggestions(self):
+        return await self.query.get_suggestions()
+
+    async def iterator(self, chunk_size=None, scroll=None):
+        """
+        Streams every result of the query using the ES Scroll Api, see SQS.iterator
+        """
+        chunks = self.query.scan(chunk_size or conf.SCROLL_SIZE, scroll or conf.SCROLL_TIMEOUT)
+        try:
+            async for hits in chunks:
+                for result in self.post_process_results(hits):
+                    yield result
+        finally:
+            await chunks.aclose()
+
+    def scan(self):
+        return self.iterator()
+
+    async def iter_json(self, start=None, end=None, chunk_size=None):
+        """
+        Yields results as a JSON array in pieces of encoded bytes, see SQS.iter_json
+        """
+        if start is None and end is None:
+            chunks = self.query.scan(chunk_size or conf.SCROLL_SIZE, conf.SCROLL_TIMEOUT)
+        else:
+            chunks = self._raw_page(start or 0, end)
+
+        encode = self._json_encoder()
+        first = True
+
+        try:
+            yield b"["
+            async for hits in chunks:
+                for item in self._json_items(hits):
+                    yield encode(item) if first else b"," + encode(item)
+                    first = False
+            yield b"]"
+        finally:
+            await chunks.aclose()
+
+    async def _raw_page(self, start, end=None):
+        yield await self._raw_page_query(start, end).get_results() or []
+
+    async def page(self, cursor=None, size=None):
+        """
+        Returns a page of results following cursor and the cursor of the next
+        page, see SQS.page
+        """
+        size = size or conf.SIZE_PER_QUERY
+        results = await self._page_query(cursor, size).get_results()
+        return self._page_results(results, size)
+
+    def index(self, doc_id, doc_body):
+        raise TypeError("AsyncSQS does not write documents, use SQS.index")
+
+    def remove(self, doc_id):
+        raise TypeError("AsyncSQS does not write documents, use SQS.remove")
+
+    def load_models(self, select_related=None, prefetch_related=None):
+        raise TypeError("AsyncSQS can not load models, the ORM would block the event loop")
+
+    def bulk(self, max_actions=None, max_bytes=None):
+        raise TypeError("AsyncSQS has no bulk indexer, use SQS.bulk")
+
+    async def get(self, doc_id, fields=None):
+        """
+        Get specified document
+        """
+        try:
+            with measure("get", self.index_name, self.doc_type) as measurement:
+                if fields:
+                    result = await self.backend.get(self.index_name, doc_id, self.doc_type, fields=fields)
+                else:
+                    result = await self.backend.get(self.index_name, doc_id, self.doc_type)
+                measurement.set_response(result)
+            return self.process_document(result, fields)
+        except NotFoundError:
+            return None
+
+    async def autocomplete(self, querystring, autocomplete_field, size=10):
+        """
+        Return autocomplete results using ES Completion Suggester, see SQS.autocomplete
+        """
+        with measure("suggest", self.index_name) as measurement:
+            resp = await self.backend.suggest(body=self._autocomplete_body(querystring, autocomplete_field, size))
+            measurement.set_response(resp)
+        return resp
+
+    async def get_many(self, ids, fields=None, source_include=None, source_exclude=None):
+        """
+        Get many documents in a single hit to ES Multi Get Api, see SQS.get_many
+        """
+        params = self._mget_params(fields, source_include, source_exclude)
+        docs, missing = self._cached_docs(ids, params)
+
+        if missing:
+            body = {"ids": missing}
+            with measure("mget", self.index_name, self.doc_type) as measurement:
+                response = await self.backend.mget(body=body, index=self.index_name, doc_type=self.doc_type, **params)
+                measurement.set_response(response)
+
+            self._cache_docs(docs, response, params)
+
+        return self._process_docs(ids, docs, fields)
@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+
+
+class SearchConfig(AppConfig):
+    name = 'search'
+    verbose_name = "Search"
+
+    def ready(self):
+        from search import conf
+        from search.signals import setup_realtime_indexing
+
+        if conf.REALTIME_INDEXING:
+            setup_realtime_indexing()
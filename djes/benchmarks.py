@@ -0,0 +1,104 @@
+"""
+Micro benchmarks of the hot paths of SQS and update_index. ES is replaced by
+the in-process stand-ins of search.testing answering with synthetic documents,
+so the numbers only measure this package. Run them with the benchmark_search
+management command.
+"""
+from __future__ import division
+import json
+import time
+
+from search.models import SQS, SearchEncoder
+from search.testing import FakeSearchBackend, FakeBulkBackend, FakeIndex, fake_rows
+
+
+def build_query(backend):
+    sqs = (SQS("content", "item", backend=backend).search("red dress", ["title", "category"])
+           .filter(brandid__in=[1, 2, 3], price__gte=10).filter_or(storeid=1, categoryid=2)
+           .facet("category").sort("-_score", "price"))
+    return sqs.query.build_query()
+
+
+def paging(backend):
+    # Pages have to be fetched every time, not served by the query cache
+    sqs = SQS("content", "item", backend=backend).no_cache()
+    for start in range(0, 100, 20):
+        sqs[start:start + 20]
+
+    # Iterating a fresh SQS goes through _manual_iter and its chunked fetches
+    return list(SQS("content", "item", backend=backend).no_cache())
+
+
+def post_process_results(backend, hits):
+    return SQS("content", "item", backend=backend).post_process_results(hits)
+
+
+def encode_results(results):
+    return json.dumps(results, cls=SearchEncoder)
+
+
+def process_facets(backend, facets):
+    return SQS("content", "item", backend=backend).query.process_facets(facets)
+
+
+def update_batch(qs, batch_size):
+    from search.management.commands.update_index import do_update
+    # Without a forget_index the fake rows leave the fingerprints in the DB alone
+    do_update(FakeBulkBackend(), FakeIndex(), "item", qs, 0, batch_size, qs.count(), False, verbosity=0)
+
+
+def measure(func, min_time=0.5):
+    """
+    Calls func repeatedly for at least min_time seconds and returns calls per
+    second along with the fastest single call
+    """
+    calls = 0
+    fastest = None
+    started = time.time()
+
+    while True:
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+
+        calls += 1
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+
+        total = time.time() - started
+        if total >= min_time:
+            return {"ops_per_sec": calls / total, "fastest": fastest, "calls": calls}
+
+
+def run_benchmarks(hits=100, fields=10, field_size=50, batch_size=1000, min_time=0.5):
+    """
+    Runs every benchmark and returns a dictionary of benchmark name -> timings
+    """
+    source = dict(("field_%d" % i, "x" * field_size) for i in range(fields))
+    backend = FakeSearchBackend(total=max(hits, 200), source=source, facet_terms=20)
+    raw_hits = backend.hits[:hits]
+    results = post_process_results(backend, raw_hits)
+    facets = backend.facets({"facets": {"category": {}, "brand": {}}})
+    qs = fake_rows(range(batch_size), source)
+
+    benchmarks = [
+        ("build_query", lambda: build_query(backend)),
+        ("paging", lambda: paging(backend)),
+        ("post_process_results", lambda: post_process_results(backend, raw_hits)),
+        ("search_encoder", lambda: encode_results(results)),
+        ("process_facets", lambda: process_facets(backend, facets)),
+        ("update_batch", lambda: update_batch(qs, batch_size)),
+    ]
+
+    return dict((name, measure(func, min_time)) for name, func in benchmarks)
+
+
+def compare(current, previous):
+    """
+    Returns benchmark name -> relative change in ops/sec against a previous run
+    """
+    changes = {}
+    for name, timings in current.items():
+        before = previous.get(name, {}).get("ops_per_sec")
+        if before:
+            changes[name] = timings["ops_per_sec"] / before - 1
+    return changes
@@ -0,0 +1,129 @@
+import json
+import logging
+import time
+
+from search import conf
+from search.signals import index_updated
+from search.instrumentation import measure
+
+
+log = logging.getLogger(__name__)
+
+
+class BulkIndexer(object):
+    """
+    Collects index and delete actions and sends them to ES through the Bulk
+    Api. Pending actions are flushed as soon as either ``max_actions`` actions
+    or ``max_bytes`` bytes of payload have been collected, whichever comes first
+    """
+    def __init__(self, backend, index_name, doc_type=None, max_actions=None, max_bytes=None):
+        self.backend = backend
+        self.index_name = index_name
+        self.doc_type = doc_type
+        self.max_actions = max_actions or conf.BULK_SIZE
+        self.max_bytes = max_bytes or conf.BULK_MAX_BYTES
+
+        self._lines = []
+        self._actions = 0
+        self._bytes = 0
+
+        self.indexed = 0
+        self.removed = 0
+        self.errors = []
+
+        # Seconds spent encoding actions and waiting for ES, bytes sent to ES
+        self.encode_time = 0.0
+        self.send_time = 0.0
+        self.bytes_sent = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def __len__(self):
+        """
+        Returns number of actions waiting to be flushed
+        """
+        return self._actions
+
+    def _meta(self, doc_id, doc_type):
+        return {"_index": self.index_name, "_type": doc_type or self.doc_type, "_id": doc_id}
+
+    def _add(self, lines):
+        for line in lines:
+            self._lines.append(line)
+            self._bytes += len(line) + 1
+
+        self._actions += 1
+
+        if self._actions >= self.max_actions or self._bytes >= self.max_bytes:
+            self.flush()
+
+    def index(self, doc_id, doc_body, doc_type=None):
+        """
+        Queue a document to be created or updated in index
+        """
+        start = time.time()
+        action = json.dumps({"index": self._meta(doc_id, doc_type)})
+        lines = [action.encode('utf-8'), json.dumps(doc_body).encode('utf-8')]
+        self.encode_time += time.time() - start
+
+        self._add(lines)
+
+    def remove(self, doc_id, doc_type=None):
+        """
+        Queue the specified document for removal
+        """
+        action = json.dumps({"delete": self._meta(doc_id, doc_type)})
+        self._add([action.encode('utf-8')])
+
+    def flush(self):
+        """
+        Sends all pending actions to ES in a single bulk request. Failed items
+        are logged and collected in ``errors`` as ``(action, doc_id, status, error)``
+        """
+        if not self._lines:
+            return []
+
+        body = b"\n".join(self._lines) + b"\n"
+        self._lines = []
+        self._actions = 0
+        self._bytes = 0
+        self.bytes_sent += len(body)
+        start = time.time()
+
+        try:
+            with measure("bulk", self.index_name, self.doc_type) as measurement:
+                resp = self.backend.bulk(body=body)
+                measurement.set_response(resp)
+        finally:
+            self.send_time += time.time() - start
+            index_updated.send(sender=BulkIndexer, index_name=self.index_name)
+
+        return self.process_response(resp)
+
+    def process_response(self, resp):
+        errors = []
+
+        for item in resp.get('items', []):
+            for action, result in item.items():
+                status = result.get('status', 200)
+
+                if action == "delete" and status == 404:
+                    # Document was already gone, that is what we wanted
+                    self.removed += 1
+                elif status >= 300 or result.get('error'):
+                    errors.append((action, result.get('_id'), status, result.get('error')))
+                elif action == "delete":
+                    self.removed += 1
+                else:
+                    self.indexed += 1
+
+        for action, doc_id, status, error in errors:
+            log.error("Bulk %s failed for %s/%s/%s (%s): %s", action, self.index_name, self.doc_type, doc_id, status, error)
+
+        self.errors.extend(errors)
+        return errors
@@ -0,0 +1,283 @@
+from bisect import bisect_right
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+
+from search import conf
+from search.signals import index_updated
+
+# Keys of a hit which are read when turning it into a result
+HIT_KEYS = ('_type', '_id', '_score', '_source', 'fields', 'sort')
+
+
+class SparseResultCache(object):
+    """
+    Result cache of a SQS. Only fetched results are stored, as contiguous
+    segments keyed by their start offset. The sorted segment starts double as
+    an interval set of cached ranges, so finding out whether a position or
+    range is cached is a binary search instead of a scan
+    """
+    def __init__(self):
+        self._starts = []
+        self._segments = {}
+
+    def __len__(self):
+        """
+        Returns number of cached results
+        """
+        return sum(len(segment) for segment in self._segments.values())
+
+    def _find(self, position):
+        """
+        Returns start of the segment containing position or None
+        """
+        i = bisect_right(self._starts, position) - 1
+        if i < 0:
+            return None
+
+        start = self._starts[i]
+        if position < start + len(self._segments[start]):
+            return start
+        return None
+
+    def add(self, start, results):
+        """
+        Stores results beginning at offset start. Overlapping and adjacent
+        segments are merged, newer results win where they overlap. Segments
+        grow in place, so filling the cache a page at a time only ever copies
+        the new page
+        """
+        if not results:
+            return
+
+        results = list(results)
+        end = start + len(results)
+        i = bisect_right(self._starts, start) - 1
+        segment = None
+
+        if i >= 0:
+            prev_start = self._starts[i]
+            prev = self._segments[prev_start]
+
+            if prev_start + len(prev) >= start:
+                # Overwrites the overlap and appends the rest to the segment
+                prev[start - prev_start:end - prev_start] = results
+                segment, start = prev, prev_start
+
+        # Position of the first segment which starts after start
+        i += 1
+        if segment is None:
+            segment = results
+            self._starts.insert(i, start)
+            self._segments[start] = segment
+            i += 1
+
+        end = start + len(segment)
+        while i < len(self._starts) and self._starts[i] <= end:
+            next_start = self._starts.pop(i)
+            following = self._segments.pop(next_start)
+            segment.extend(following[end - next_start:])
+            end = start + len(segment)
+
+    def get(self, position):
+        """
+        Returns cached result at position, raises IndexError if it is not cached
+        """
+        start = self._find(position)
+        if start is None:
+            raise IndexError(position)
+        return self._segments[start][position - start]
+
+    def is_cached(self, start, end):
+        """
+        Checks if every position from start up to end is cached
+        """
+        if end <= start:
+            return True
+
+        segment_start = self._find(start)
+        if segment_start is None:
+            return False
+        return segment_start + len(self._segments[segment_start]) >= end
+
+    def slice(self, start, end=None):
+        """
+        Returns cached results from start up to end, stopping at the first
+        position which is not cached. Without end the whole cached run is returned
+        """
+        segment_start = self._find(start)
+        if segment_start is None:
+            return []
+
+        segment = self._segments[segment_start]
+        stop = len(segment) if end is None else min(end - segment_start, len(segment))
+        return segment[start - segment_start:stop]
+
+    def clear(self):
+        self._starts = []
+        self._segments = {}
+
+
+def make_key(index, doc_type, body, params):
+    """
+    Returns a stable hash of everything that decides the response of a search
+    """
+    data = json.dumps([index, doc_type, body, params], sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def compact_response(results):
+    """
+    Strips a search response down to the parts Query reads
+    """
+    hits = [dict((key, hit[key]) for key in HIT_KEYS if key in hit) for hit in results['hits'].get('hits', [])]
+    compact = {"hits": {"total": results['hits']['total'], "hits": hits}}
+
+    for key in ('facets', 'suggest'):
+        if key in results:
+            compact[key] = results[key]
+
+    return compact
+
+
+class BaseQueryCache(object):
+    """
+    Shared cache of search responses. Every index has a generation number
+    which is part of the key of its responses, bumping it on writes makes
+    all cached responses of that index unreachable at once
+    """
+    def get_timeout(self, index):
+        return conf.QUERY_CACHE_TTL.get(index, conf.QUERY_CACHE_DEFAULT_TTL)
+
+    def _key(self, index, key):
+        return "djes:%s:%s:%s" % (index, self.get_generation(index), key)
+
+    def get(self, index, key):
+        return self._get(self._key(index, key))
+
+    def set(self, index, key, value):
+        timeout = self.get_timeout(index)
+        if timeout:
+            self._set(self._key(index, key), value, timeout)
+
+    def get_generation(self, index):
+        raise NotImplementedError
+
+    def invalidate(self, index):
+        raise NotImplementedError
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value, timeout):
+        raise NotImplementedError
+
+
+class LocMemQueryCache(BaseQueryCache):
+    """
+    In-process LRU cache of search responses
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or conf.QUERY_CACHE_SIZE
+        self._data = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def get_generation(self, index):
+        return self._generations.get(index, 0)
+
+    def invalidate(self, index):
+        with self._lock:
+            self._generations[index] = self._generations.get(index, 0) + 1
+
+    def _get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return None
+
+            if expires < time.time():
+                return None
+
+            # Re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def _set(self, key, value, timeout):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + timeout, value)
+
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+class DjangoQueryCache(BaseQueryCache):
+    """
+    Search response cache stored in a Django cache backend, shared by all
+    processes using that backend
+    """
+    def __init__(self, alias):
+        try:
+            from django.core.cache import caches
+            self.cache = caches[alias]
+        except ImportError:
+            from django.core.cache import get_cache
+            self.cache = get_cache(alias)
+
+    def _generation_key(self, index):
+        return "djes:generation:%s" % index
+
+    def get_generation(self, index):
+        return self.cache.get(self._generation_key(index), 0)
+
+    def invalidate(self, index):
+        try:
+            self.cache.incr(self._generation_key(index))
+        except ValueError:
+            # Generation does not exist yet. Never expire it, expiring would
+            # bring back responses cached under the old generation.
+            self.cache.set(self._generation_key(index), 1, None)
+
+    def _get(self, key):
+        return self.cache.get(key)
+
+    def _set(self, key, value, timeout):
+        self.cache.set(key, value, timeout)
+
+
+_query_cache = None
+
+
+def get_query_cache():
+    """
+    Returns the configured query cache of this process or None when
+    query caching is disabled
+    """
+    global _query_cache
+
+    if _query_cache is None and conf.QUERY_CACHE:
+        if conf.QUERY_CACHE == "locmem":
+            _query_cache = LocMemQueryCache()
+        else:
+            _query_cache = DjangoQueryCache(conf.QUERY_CACHE)
+
+    return _query_cache
+
+
+def invalidate_index(index_name):
+    """
+    Drops cached responses of index_name
+    """
+    cache = get_query_cache()
+    if cache is not None:
+        cache.invalidate(index_name)
+
+
+def index_updated_receiver(sender, index_name, **kwargs):
+    invalidate_index(index_name)
+
+index_updated.connect(index_updated_receiver, dispatch_uid="djes_query_cache")
@@ -1,8 +1,58 @@
+from django.conf import settings
+
 from search.indexes import ContentIndex
 
 DEFAULT_FILTER = "AND"
 REPR_OUTPUT_SIZE = 10
 SIZE_PER_QUERY = 10
+BULK_SIZE = 500
+BULK_MAX_BYTES = 10 * 1024 * 1024
+SCROLL_SIZE = 500
+SCROLL_TIMEOUT = "5m"
+# Reconciling holds a scroll open while it reads every primary key from the DB
+RECONCILE_SCROLL_TIMEOUT = "30m"
+CURSOR_TIEBREAKER = "_id"
+
+# Send filter_path with searches so ES leaves out every part of the response
+# SQS does not read. Needs ES 1.6 or later.
+FILTER_PATH = getattr(settings, 'ELASTICSEARCH_FILTER_PATH', False)
+
+# Shared query result cache. None disables it, "locmem" keeps results in an
+# in-process LRU, any other value is used as a Django cache alias.
+QUERY_CACHE = getattr(settings, 'ELASTICSEARCH_QUERY_CACHE', None)
+QUERY_CACHE_SIZE = getattr(settings, 'ELASTICSEARCH_QUERY_CACHE_SIZE', 1000)
+QUERY_CACHE_DEFAULT_TTL = getattr(settings, 'ELASTICSEARCH_QUERY_CACHE_DEFAULT_TTL', 60)
+QUERY_CACHE_TTL = getattr(settings, 'ELASTICSEARCH_QUERY_CACHE_TTL', {})
+
+# Connections to ES, see search.connection. Every process has a single
+# client whose pooled connections are kept alive and reused between requests.
+POOL_SIZE = getattr(settings, 'ELASTICSEARCH_POOL_SIZE', 10)  # connections per node
+TIMEOUT = getattr(settings, 'ELASTICSEARCH_TIMEOUT', 10)
+MAX_RETRIES = getattr(settings, 'ELASTICSEARCH_MAX_RETRIES', 3)
+RETRY_ON_TIMEOUT = getattr(settings, 'ELASTICSEARCH_RETRY_ON_TIMEOUT', False)
+# gzip request bodies, bulk payloads shrink a lot
+COMPRESS = getattr(settings, 'ELASTICSEARCH_COMPRESS', False)
+SNIFF_ON_START = getattr(settings, 'ELASTICSEARCH_SNIFF_ON_START', False)
+SNIFF_ON_CONNECTION_FAIL = getattr(settings, 'ELASTICSEARCH_SNIFF_ON_CONNECTION_FAIL', False)
+SNIFFER_TIMEOUT = getattr(settings, 'ELASTICSEARCH_SNIFFER_TIMEOUT', None)  # seconds between sniffs
+# Any other keyword arguments for the client
+CONNECTION_OPTIONS = getattr(settings, 'ELASTICSEARCH_CONNECTION_OPTIONS', {})
+
+# Record timing of every request to ES, see search.instrumentation
+INSTRUMENT = getattr(settings, 'ELASTICSEARCH_INSTRUMENT', getattr(settings, 'DEBUG', False))
+INSTRUMENT_LOG_SIZE = getattr(settings, 'ELASTICSEARCH_INSTRUMENT_LOG_SIZE', 9000)
+
+# Queue saves and deletes of the models behind INDEXES in the index outbox,
+# which drain_index sends to ES. See search.signals.setup_realtime_indexing
+REALTIME_INDEXING = getattr(settings, 'ELASTICSEARCH_REALTIME_INDEXING', False)
+
+# Keep fingerprints of the documents sent by update_index --fingerprints, see
+# search.fingerprints. Every other write then drops the fingerprints of the
+# documents it touches, which costs a DELETE per write.
+FINGERPRINTS = getattr(settings, 'ELASTICSEARCH_FINGERPRINTS', False)
+
+# Number of connections per node kept open by the asyncio client of AsyncSQS
+ASYNC_POOL_SIZE = getattr(settings, 'ELASTICSEARCH_ASYNC_POOL_SIZE', 100)
 
 INDEXES = {
     'content': ContentIndex
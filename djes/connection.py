@@ -0,0 +1,76 @@
+import os
+import threading
+
+from django.conf import settings
+
+from elasticsearch import Elasticsearch
+
+
+_backend = None
+_backend_pid = None
+_lock = threading.Lock()
+
+
+def client_options(**overrides):
+    """
+    Returns keyword arguments for an ES client built from the connection settings
+    """
+    from search import conf
+
+    from search.instrumentation import InstrumentedSerializer
+
+    options = {
+        'serializer': InstrumentedSerializer(),
+        'maxsize': conf.POOL_SIZE,
+        'timeout': conf.TIMEOUT,
+        'max_retries': conf.MAX_RETRIES,
+        'retry_on_timeout': conf.RETRY_ON_TIMEOUT,
+        'sniff_on_start': conf.SNIFF_ON_START,
+        'sniff_on_connection_fail': conf.SNIFF_ON_CONNECTION_FAIL,
+    }
+
+    # Only passed when asked for, clients which predate them would choke
+    if conf.COMPRESS:
+        options['http_compress'] = True
+    if conf.SNIFFER_TIMEOUT is not None:
+        options['sniffer_timeout'] = conf.SNIFFER_TIMEOUT
+
+    options.update(conf.CONNECTION_OPTIONS)
+    options.update(overrides)
+    return options
+
+
+def create_backend(**overrides):
+    """
+    Returns a new ES client, most code wants the shared one from get_backend
+    """
+    return Elasticsearch(settings.ELASTICSEARCH_NODES, **client_options(**overrides))
+
+
+def get_backend():
+    """
+    Returns the ES client of this process. It is created on first use, and
+    again in a forked child, which must not share sockets with its parent.
+    The client's connection pool is thread safe
+    """
+    global _backend, _backend_pid
+
+    pid = os.getpid()
+    if _backend is None or _backend_pid != pid:
+        with _lock:
+            if _backend is None or _backend_pid != pid:
+                _backend = create_backend()
+                _backend_pid = pid
+
+    return _backend
+
+
+def reset_backend():
+    """
+    Drops the client of this process, the next get_backend builds a new one
+    """
+    global _backend, _backend_pid
+
+    with _lock:
+        _backend = None
+        _backend_pid = None
@@ -1 +1,3 @@
-MISSING_PARAMS = "Required parameters missing"
\ No newline at end of file
+MISSING_PARAMS = "Required parameters missing"
+INVALID_CURSOR = "Invalid pagination cursor"
+MLT_CURSOR = "More like this queries can not be paged with a cursor"
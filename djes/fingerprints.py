@@ -0,0 +1,92 @@
+import hashlib
+import json
+
+from search.models import IndexFingerprint
+
+
+def fingerprint(doc):
+    """
+    Returns a hash of a search dict which does not depend on key order
+    """
+    data = json.dumps(doc, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class FingerprintStore(object):
+    """
+    Fingerprints of documents of an index/doc_type which have been sent to ES.
+    With ``force`` every document counts as changed, but fingerprints are still
+    recorded, which is what a rebuild into an empty index needs.
+
+    Every other write to the index has to forget the fingerprints of the
+    documents it touches, or they would wrongly count as up to date
+    """
+    def __init__(self, index_name, doc_type, force=False):
+        self.index_name = index_name
+        self.doc_type = doc_type
+        self.force = force
+
+    def _entries(self):
+        return IndexFingerprint.objects.filter(index_name=self.index_name, doc_type=self.doc_type)
+
+    def changed(self, docs):
+        """
+        Takes a dictionary of pk -> search dict and returns pk -> (search dict, fingerprint)
+        of the documents whose fingerprint differs from the stored one
+        """
+        fingerprints = dict((pk, fingerprint(doc)) for pk, doc in docs.items())
+
+        if self.force:
+            stored = {}
+        else:
+            stored = dict(self._entries().filter(object_pk__in=[str(pk) for pk in docs])
+                          .values_list('object_pk', 'fingerprint'))
+
+        return dict((pk, (docs[pk], fp)) for pk, fp in fingerprints.items() if stored.get(str(pk)) != fp)
+
+    def record(self, fingerprints):
+        """
+        Stores fingerprints given as a dictionary of pk -> fingerprint
+        """
+        if not fingerprints:
+            return
+
+        self.forget(fingerprints.keys())
+        IndexFingerprint.objects.bulk_create([
+            IndexFingerprint(index_name=self.index_name, doc_type=self.doc_type, object_pk=str(pk), fingerprint=fp)
+            for pk, fp in fingerprints.items()
+        ])
+
+    def forget(self, pks):
+        IndexFingerprint.forget(self.index_name, self.doc_type, pks)
+
+    def update(self, bulk, items, active_field, remove=False):
+        """
+        Sends changed documents among items through bulk, flushes it and records
+        fingerprints of what ES accepted. Returns number of unchanged documents
+        which were skipped
+        """
+        docs = {}
+        removed = []
+
+        for item in items:
+            if getattr(item, active_field):
+                docs[item.pk] = item.get_search_dict()
+            elif remove:
+                removed.append(item.pk)
+
+        changed = self.changed(docs)
+
+        for pk, (doc, fp) in changed.items():
+            bulk.index(pk, doc)
+        for pk in removed:
+            bulk.remove(pk)
+
+        bulk.flush()
+
+        # Failed documents are left without a fingerprint so they are sent next time
+        failed = set(str(error[1]) for error in bulk.errors)
+        self.record(dict((pk, fp) for pk, (doc, fp) in changed.items() if str(pk) not in failed))
+        self.forget([pk for pk in removed if str(pk) not in failed])
+
+        return len(docs) - len(changed)
@@ -0,0 +1,157 @@
+"""
+Timing of every request made to ES. With ``ELASTICSEARCH_INSTRUMENT`` on
+(it follows ``DEBUG`` by default) each request is appended to a log, much
+like ``connection.queries``, and ``search_executed`` is sent with its record.
+The log is emptied when Django starts a request.
+
+The log belongs to the current context, so concurrent asyncio tasks which
+call reset_queries() each get their own. Without contextvars (before Python
+3.7, unless the backport is installed) there is one log per thread.
+"""
+import collections
+import threading
+import time
+
+from django.core.signals import request_started
+
+from elasticsearch.serializer import JSONSerializer
+
+from search import conf
+from search.signals import search_executed
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+
+class _ThreadVar(threading.local):
+    # Stands in for ContextVar, with one value per thread
+    def __init__(self, name, default=None):
+        self.value = default
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+_var_class = ContextVar or _ThreadVar
+_queries = _var_class('djes_queries', default=None)
+# Measurement of the request in progress, its body sizes are noted on it
+_current = _var_class('djes_measurement', default=None)
+
+
+def _log():
+    log = _queries.get()
+    if log is None:
+        log = collections.deque(maxlen=conf.INSTRUMENT_LOG_SIZE)
+        _queries.set(log)
+    return log
+
+
+def get_queries():
+    """
+    Returns records of the requests made to ES in this context since the last reset
+    """
+    return list(_log())
+
+
+def reset_queries(**kwargs):
+    # A new log rather than clearing the old one, which other contexts may share
+    _queries.set(collections.deque(maxlen=conf.INSTRUMENT_LOG_SIZE))
+
+request_started.connect(reset_queries, dispatch_uid="djes_reset_queries")
+
+
+class InstrumentedSerializer(JSONSerializer):
+    """
+    JSON serializer of the ES client which notes the size of every request
+    and response body on the measurement in progress. Sizes are counted in
+    characters of the JSON text the client sends and reads, before any
+    compression, and cost nothing beyond a len()
+    """
+    def dumps(self, data):
+        data = super(InstrumentedSerializer, self).dumps(data)
+
+        measurement = _current.get()
+        if measurement is not None:
+            # Bulk and multi search bodies are joined from serialized lines,
+            # which pass through here once more as the body that is sent
+            measurement.request_size = len(data)
+
+        return data
+
+    def loads(self, s):
+        measurement = _current.get()
+        if measurement is not None:
+            measurement.response_size = len(s)
+
+        return super(InstrumentedSerializer, self).loads(s)
+
+
+class measure(object):
+    """
+    Context manager timing a single request to ES::
+
+        with measure("search", index, doc_type) as measurement:
+            measurement.set_response(backend.search(...))
+
+    Nothing is computed unless instrumentation is on
+    """
+    def __init__(self, operation, index_name, doc_type=None):
+        self.operation = operation
+        self.index_name = index_name
+        self.doc_type = doc_type
+        self.response = None
+        self.cache = None
+        self.request_size = None
+        self.response_size = None
+        self.start = None
+        self._outer = None
+
+    def __enter__(self):
+        if conf.INSTRUMENT:
+            self._outer = _current.get()
+            _current.set(self)
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is None:
+            return
+
+        duration = time.time() - self.start
+        _current.set(self._outer)
+
+        record = self.record(duration, exc_value)
+        _log().append(record)
+        search_executed.send(sender=measure, record=record)
+
+    def set_response(self, response, cache=None):
+        """
+        Keeps the response of the request, cache is "hit" for one which came
+        from the query cache, "miss" for one about to be stored there
+        """
+        self.response = response
+        self.cache = cache
+
+    def record(self, duration, error=None):
+        response = self.response if isinstance(self.response, dict) else {}
+        hits = response.get('hits')
+
+        return {
+            'operation': self.operation,
+            'index': self.index_name,
+            'doc_type': self.doc_type,
+            'time': duration,
+            'took': response.get('took'),
+            # Only known for clients using InstrumentedSerializer, a cached
+            # response never went over the wire
+            'request_size': self.request_size,
+            'response_size': self.response_size,
+            'hits': hits.get('total') if isinstance(hits, dict) else None,
+            'cache': self.cache,
+            'error': repr(error) if error is not None else None,
+        }
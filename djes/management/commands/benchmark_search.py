@@ -0,0 +1,97 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from optparse import make_option
+import json
+import platform
+
+from django.core.management.base import BaseCommand
+
+try:
+    from django.utils.timezone import now
+except ImportError:
+    from datetime import datetime
+    now = datetime.now
+
+from search.benchmarks import run_benchmarks, compare
+
+DEFAULT_OUTPUT = "djes_benchmarks.jsonl"
+
+
+class Command(BaseCommand):
+    help = "Benchmarks query building, result processing and indexing against an in-process fake ES"
+    option_list = BaseCommand.option_list + (
+        make_option('--hits', action='store', dest='hits',
+            default=100, type='int',
+            help='Number of hits per result set.'
+        ),
+        make_option('--fields', action='store', dest='fields',
+            default=10, type='int',
+            help='Number of fields of every synthetic document.'
+        ),
+        make_option('--field-size', action='store', dest='field_size',
+            default=50, type='int',
+            help='Number of characters of every field.'
+        ),
+        make_option('-b', '--batch-size', action='store', dest='batchsize',
+            default=1000, type='int',
+            help='Number of rows of an update_index batch.'
+        ),
+        make_option('--min-time', action='store', dest='min_time',
+            default=0.5, type='float',
+            help='Seconds every benchmark runs for.'
+        ),
+        make_option('-o', '--output', action='store', dest='output',
+            default=DEFAULT_OUTPUT, type='string',
+            help='File results are appended to, one JSON line per run.'
+        ),
+        make_option('--label', action='store', dest='label',
+            default=None, type='string',
+            help='Name of this run, e.g. a commit or branch, stored with the results.'
+        ),
+    )
+
+    def handle(self, **options):
+        settings = {
+            'hits': options.get('hits'),
+            'fields': options.get('fields'),
+            'field_size': options.get('field_size'),
+            'batch_size': options.get('batchsize'),
+        }
+        results = run_benchmarks(min_time=options.get('min_time'), **settings)
+        previous = self.last_run(options['output'], settings)
+        changes = compare(results, previous['results']) if previous else {}
+
+        for name in sorted(results):
+            line = "%-22s %12.1f ops/s  fastest %.6fs" % (name, results[name]['ops_per_sec'], results[name]['fastest'])
+            if name in changes:
+                line += "  %+.1f%% vs %s" % (100 * changes[name], previous.get('label') or previous['timestamp'])
+            print(line)
+
+        run = {
+            'timestamp': now().isoformat(),
+            'label': options.get('label'),
+            'python': platform.python_version(),
+            'settings': settings,
+            'results': results,
+        }
+        with open(options['output'], 'a') as output:
+            output.write(json.dumps(run, sort_keys=True) + "\n")
+
+    def last_run(self, path, settings):
+        """
+        Returns the latest recorded run made with the same settings, if any
+        """
+        last = None
+
+        try:
+            with open(path) as runs:
+                for line in runs:
+                    line = line.strip()
+                    if line:
+                        run = json.loads(line)
+                        if run.get('settings') == settings:
+                            last = run
+        except IOError:
+            pass
+
+        return last
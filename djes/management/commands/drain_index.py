@@ -0,0 +1,130 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from optparse import make_option
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import reset_queries
+
+try:
+    from django.utils.timezone import now
+except ImportError:
+    from datetime import datetime
+    now = datetime.now
+
+from search.connection import get_backend
+from search.models import SQS, IndexOutbox, IndexFingerprint
+from search.conf import INDEXES, BULK_SIZE, BULK_MAX_BYTES
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_INTERVAL = 5
+
+
+def get_index(index_name):
+    for index_class in INDEXES.values():
+        if index_class.index_name == index_name:
+            return index_class()
+    return None
+
+
+def drain(backend, batch_size=DEFAULT_BATCH_SIZE, bulk_size=BULK_SIZE, bulk_bytes=BULK_MAX_BYTES, verbosity=1):
+    """
+    Sends one batch of outbox entries per index and doc_type to ES and removes
+    them from the outbox. Returns number of entries which were sent successfully
+    """
+    sent = 0
+    groups = IndexOutbox.objects.values_list('index_name', 'doc_type').distinct()
+
+    for index_name, doc_type in list(groups):
+        index = get_index(index_name)
+        if index is None:
+            logging.warning("Outbox entries for unknown index %s left alone", index_name)
+            continue
+
+        # Entries touched again after this point have to stay for the next drain
+        started = now()
+        entries = list(IndexOutbox.objects.filter(index_name=index_name, doc_type=doc_type)
+                       .order_by('modified')[:batch_size])
+        pks = [entry.object_pk for entry in entries]
+
+        # Objects missing from the queryset were deleted or are no longer
+        # indexable, either way they have to go from the index.
+        qs = getattr(index, "%s_queryset" % doc_type)(start_date=None, end_date=None)
+        objects = dict((str(pk), obj) for pk, obj in qs.in_bulk(pks).items())
+
+        sqs = SQS(index.index_name, doc_type, backend=backend)
+        with sqs.bulk(bulk_size, bulk_bytes) as bulk:
+            for pk in pks:
+                obj = objects.get(pk)
+                if obj is not None and getattr(obj, index.active_field):
+                    bulk.index(obj.pk, obj.get_search_dict())
+                else:
+                    bulk.remove(pk)
+
+        IndexFingerprint.forget(index_name, doc_type, pks)
+
+        # Failed documents stay in the outbox and are retried next time
+        failed = set(str(error[1]) for error in bulk.errors)
+        done = [entry.pk for entry in entries if entry.object_pk not in failed]
+        IndexOutbox.objects.filter(pk__in=done, modified__lte=started).delete()
+
+        if verbosity >= 2:
+            print("  drained %d %s-%s (%d failed)." % (len(entries), index_name, doc_type, len(failed)))
+
+        sent += len(done)
+        reset_queries()
+
+    return sent
+
+
+class Command(BaseCommand):
+    help = "Sends changes recorded in the index outbox to ES"
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--batch-size', action='store', dest='batchsize',
+            default=DEFAULT_BATCH_SIZE, type='int',
+            help='Number of outbox entries per index and doc_type to process at once.'
+        ),
+        make_option('--bulk-size', action='store', dest='bulk_size',
+            default=BULK_SIZE, type='int',
+            help='Maximum number of actions sent to ES in a single bulk request.'
+        ),
+        make_option('--bulk-bytes', action='store', dest='bulk_bytes',
+            default=BULK_MAX_BYTES, type='int',
+            help='Maximum payload size in bytes of a single bulk request.'
+        ),
+        make_option('--loop', action='store_true', dest='loop',
+            default=False, help='Keep draining the outbox instead of exiting once it is empty.'
+        ),
+        make_option('-i', '--interval', action='store', dest='interval',
+            default=DEFAULT_INTERVAL, type='int',
+            help='Seconds to wait between drains of an empty outbox with --loop.'
+        ),
+    )
+
+    def handle(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = int(options.get('batchsize') or DEFAULT_BATCH_SIZE)
+        bulk_size = int(options.get('bulk_size') or BULK_SIZE)
+        bulk_bytes = int(options.get('bulk_bytes') or BULK_MAX_BYTES)
+        interval = int(options.get('interval') or DEFAULT_INTERVAL)
+        backend = get_backend()
+
+        while True:
+            try:
+                sent = drain(backend, batch_size, bulk_size, bulk_bytes, verbosity)
+            except Exception:
+                if not options.get('loop'):
+                    raise
+                logging.exception("Error draining index outbox")
+                sent = 0
+
+            # Keep going while there is progress, failing entries alone
+            # should not keep us busy.
+            if sent:
+                continue
+
+            if not options.get('loop'):
+                break
+
+            time.sleep(interval)
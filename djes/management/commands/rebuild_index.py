@@ -1,27 +1,181 @@
-from django.core.management.base import LabelCommand
+import copy
+import re
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import LabelCommand, CommandError
 from django.core.management import call_command
-from django.conf import settings
 
-from elasticsearch import Elasticsearch
+try:
+    from django.utils.timezone import now
+except ImportError:
+    from datetime import datetime
+    now = datetime.now
+
+from elasticsearch import NotFoundError
+from search.connection import get_backend
 from search.management.commands.update_index import Command as UpdateCommand
 from search import conf
-from search.models import SQS
+from search.models import SQS, IndexCheckpoint, IndexFingerprint
+from search.signals import index_updated
+
+# Settings applied to a freshly created index while it is being populated.
+# Refreshes and replication only slow the bulk load down, nobody is searching
+# the new index until its alias is swapped.
+BULK_LOAD_SETTINGS = {"index": {"refresh_interval": "-1", "number_of_replicas": 0}}
+DEFAULT_REFRESH_INTERVAL = "1s"
+DEFAULT_KEEP = 0
+# Alias marking the versioned indices which were once behind the alias and got
+# swapped out, only those are considered by --keep
+RETIRED_ALIAS = "%s_retired"
 
 
 class Command(LabelCommand):
-    help = "Completely rebuilds the search index by removing the old data and then updating."
+    help = "Completely rebuilds the search index into a new versioned index and then swaps the alias to it."
     option_list = list(LabelCommand.option_list) + \
-                  [option for option in UpdateCommand.base_options if option.get_opt_string() != '--verbosity']
+                  [option for option in UpdateCommand.base_options if option.get_opt_string() != '--verbosity'] + \
+                  [make_option('--keep', action='store', dest='keep',
+                       default=DEFAULT_KEEP, type='int',
+                       help='Number of previously live indices to keep around after the alias is swapped.'
+                  )]
 
     def handle_label(self, label, **options):
-        backend = Elasticsearch(settings.ELASTICSEARCH_NODES)
+        self.backend = get_backend()
+        keep = int(options.pop('keep', DEFAULT_KEEP) or 0)
+
         if len(label.split('.')) > 1:
             index = conf.INDEXES[label.split('.')[0]]
         else:
             index = conf.INDEXES[label]
-        sqs = SQS(index.index_name, backend=backend)
 
-        if sqs.check_index():
-            sqs.delete_index()
-        sqs.create_index(index.settings)
-        call_command('update_index', label, **options)
+        alias = index.index_name
+        new_index = None
+
+        if options.get('resume'):
+            new_index = self.resumable_index(alias)
+
+        if new_index is None:
+            # Nothing to pick up, checkpoints of an earlier rebuild get started over
+            options['resume'] = False
+            new_index = "%s_%s" % (alias, now().strftime("%Y%m%d%H%M%S"))
+            sqs = SQS(new_index, backend=self.backend)
+            sqs.create_index(self.bulk_load_body(index.settings))
+        else:
+            sqs = SQS(new_index, backend=self.backend)
+
+        # Batches by primary key range record checkpoints, which lets an
+        # interrupted rebuild be resumed. They are kept until the alias is
+        # swapped, a rebuild dying before that is resumed from there.
+        options['keyset'] = True
+        call_command('update_index', label, target_index=new_index, keep_checkpoints=True, **options)
+
+        if IndexCheckpoint.objects.filter(index_name=alias, target_index=new_index, done=False).exists():
+            raise CommandError("Documents of %s failed to be indexed, run with --resume to send them again "
+                               "before the alias is swapped." % new_index)
+
+        # Rows changed while the build ran only made it into the live index
+        self.catch_up(label, new_index, options)
+
+        # Put back what the index definition asked for before anyone searches it.
+        index_settings = index.settings.get("settings", {})
+        sqs.update_settings({"index": {
+            "refresh_interval": index_settings.get("refresh_interval", DEFAULT_REFRESH_INTERVAL),
+            "number_of_replicas": index_settings.get("number_of_replicas", 1),
+        }})
+        sqs.refresh_index()
+
+        self.swap_alias(alias, new_index)
+        IndexCheckpoint.objects.filter(index_name=alias, target_index=new_index).delete()
+        self.remove_old_indices(alias, new_index, keep)
+
+    def catch_up(self, label, new_index, options):
+        """
+        Sends whatever changed since the build of new_index started into it
+        """
+        options = dict(options, start_date=self.build_started(new_index).isoformat(), end_date=None, age=None,
+                       remove=True, keyset=False, resume=False, reconcile=False, profile=False)
+        call_command('update_index', label, target_index=new_index, **options)
+
+    def build_started(self, new_index):
+        """
+        Returns when the build of versioned index new_index started, which
+        its name records
+        """
+        started = datetime.strptime(new_index[-14:], "%Y%m%d%H%M%S")
+        # Names are stamped with now(), which is in UTC with time zone support
+        return started.replace(tzinfo=now().tzinfo)
+
+    def resumable_index(self, alias):
+        """
+        Returns the versioned index an interrupted rebuild of alias was writing
+        into, or None when there is none left
+        """
+        checkpoints = IndexCheckpoint.objects.filter(index_name=alias).exclude(target_index='').order_by('-modified')
+
+        for checkpoint in checkpoints[:1]:
+            if self.backend.indices.exists(checkpoint.target_index):
+                return checkpoint.target_index
+
+        return None
+
+    def bulk_load_body(self, body):
+        """
+        Returns a copy of index body with bulk load settings applied
+        """
+        body = copy.deepcopy(body)
+        index_settings = body.setdefault("settings", {})
+        index_settings.pop("refresh_interval", None)
+        index_settings.pop("number_of_replicas", None)
+        index_settings.setdefault("index", {}).update(BULK_LOAD_SETTINGS["index"])
+        return body
+
+    def get_aliased(self, name):
+        """
+        Returns names of the indices behind alias name
+        """
+        try:
+            return set(self.backend.indices.get_alias(name=name).keys())
+        except NotFoundError:
+            return set()
+
+    def swap_alias(self, alias, new_index):
+        """
+        Atomically points alias to new_index, removing it from every other index.
+        Those indices are marked as retired in the same step. Fingerprints
+        recorded while building new_index replace those of alias
+        """
+        actions = []
+        current = self.get_aliased(alias)
+
+        for old_index in current - set([new_index]):
+            actions.append({"remove": {"index": old_index, "alias": alias}})
+            actions.append({"add": {"index": old_index, "alias": RETIRED_ALIAS % alias}})
+        actions.append({"add": {"index": new_index, "alias": alias}})
+
+        if not current and self.backend.indices.exists(alias):
+            # An index created before versioning is sitting on the alias name.
+            # It has to go before the alias can be created, this only happens once.
+            self.backend.indices.delete(alias)
+
+        self.backend.indices.update_aliases(body={"actions": actions})
+
+        if conf.FINGERPRINTS:
+            IndexFingerprint.objects.filter(index_name=alias).delete()
+            IndexFingerprint.objects.filter(index_name=new_index).update(index_name=alias)
+
+        index_updated.send(sender=Command, index_name=alias)
+
+    def remove_old_indices(self, alias, new_index, keep):
+        """
+        Deletes retired versioned indices of alias except the keep newest ones.
+        Builds which never went live, like an interrupted rebuild waiting to be
+        resumed, are left alone, and so is whatever the alias points to
+        """
+        pattern = re.compile(r"^%s_\d{14}$" % re.escape(alias))
+        live = self.get_aliased(alias) | set([new_index])
+
+        old_indices = sorted([name for name in self.get_aliased(RETIRED_ALIAS % alias)
+                              if pattern.match(name) and name not in live], reverse=True)
+
+        for name in old_indices[keep:]:
+            self.backend.indices.delete(name)
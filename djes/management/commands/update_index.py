@@ -1,12 +1,13 @@
 from __future__ import print_function
 from __future__ import unicode_literals
+from collections import namedtuple
 from datetime import timedelta
 from optparse import make_option
+import json
 import logging
 import os
 
 from django import db
-from django.conf import settings
 from django.core.management.base import LabelCommand, CommandError
 from django.db import reset_queries
 from django.db.models import get_model
@@ -27,15 +28,25 @@ except ImportError:
     from datetime import datetime
     now = datetime.now
 
-from elasticsearch import Elasticsearch
-from search.models import SQS
-from search.conf import INDEXES
+from search.connection import get_backend
+from search.models import SQS, IndexCheckpoint, IndexFingerprint
+from search.pipeline import IndexingPipeline
+from search.reconcile import find_orphans
+from search.fingerprints import FingerprintStore
+from search.profiling import Profiler, BatchTimer
+from search.conf import INDEXES, BULK_SIZE, BULK_MAX_BYTES
+from search import conf
 
 DEFAULT_BATCH_SIZE = 1000
 DEFAULT_AGE = None
 
+# Everything a worker process needs to index one batch
+Batch = namedtuple('Batch', ['index', 'doctype', 'start', 'end', 'total', 'start_date', 'end_date', 'remove',
+                             'verbosity', 'bulk_size', 'bulk_bytes', 'pk_range', 'fingerprints', 'forget_index',
+                             'profile'])
 
-def worker(bits):
+
+def worker(batch):
     # We need to reset the connections, otherwise the different processes
     # will try to share the connection, which causes things to blow up.
     from django.db import connections
@@ -53,18 +64,78 @@ def worker(bits):
             except KeyError:
                 pass
 
-    index, doctype, start, end, total, start_date, end_date, remove, verbosity = bits
-    backend = Elasticsearch(settings.ELASTICSEARCH_NODES)
+    # One client per worker process, shared by all of its batches
+    backend = get_backend()
+
+    qs = getattr(batch.index, "%s_queryset" % batch.doctype)(start_date=batch.start_date, end_date=batch.end_date)
+    return do_update(backend, batch.index, batch.doctype, qs, batch.start, batch.end, batch.total, batch.remove,
+                     verbosity=batch.verbosity, bulk_size=batch.bulk_size, bulk_bytes=batch.bulk_bytes,
+                     pk_range=batch.pk_range, fingerprints=batch.fingerprints, forget_index=batch.forget_index,
+                     profile=batch.profile)
+
+
+def keyset_ranges(qs, batch_size, after_pk=None):
+    """
+    Walks the primary keys of the queryset in order and yields ``(after_pk, last_pk)``
+    tuples, each covering at most ``batch_size`` rows. ``after_pk`` is exclusive
+    (``None`` for the first range) and ``last_pk`` is inclusive. Every step is a
+    ``pk > after_pk ORDER BY pk`` lookup, so late ranges cost the same as early ones.
+    Passing ``after_pk`` starts the walk after that primary key.
+    """
+    pks = qs.order_by('pk').values_list('pk', flat=True)
+
+    while True:
+        remaining = pks if after_pk is None else pks.filter(pk__gt=after_pk)
+        boundary = list(remaining[batch_size - 1:batch_size])
+
+        if boundary:
+            last_pk = boundary[0]
+        else:
+            # Less than a full batch left, the final range ends at the highest pk.
+            tail = list(remaining.reverse()[:1])
+            if not tail:
+                return
+            last_pk = tail[0]
+
+        yield after_pk, last_pk
 
-    qs = getattr(index, "%s_queryset" % doctype)(start_date=start_date, end_date=end_date)
-    do_update(backend, index, doctype, qs, start, end, total, remove, verbosity=verbosity)
+        if not boundary:
+            return
+        after_pk = last_pk
 
 
-def do_update(backend, index, doctype, qs, start, end, total, remove, verbosity=1):
+def batch_queryset(qs, start, end, pk_range=None):
+    """
+    Returns the part of queryset covered by a batch, either a primary key range
+    or a start/end slice
+    """
     # Get a clone of the QuerySet so that the cache doesn't bloat up
     # in memory. Useful when reindexing large amounts of data.
     small_cache_qs = qs.all()
-    current_qs = small_cache_qs[start:end]
+
+    if pk_range is not None:
+        after_pk, last_pk = pk_range
+        if after_pk is not None:
+            small_cache_qs = small_cache_qs.filter(pk__gt=after_pk)
+        return small_cache_qs.filter(pk__lte=last_pk).order_by('pk')
+
+    return small_cache_qs[start:end]
+
+
+def do_update(backend, index, doctype, qs, start, end, total, remove, verbosity=1,
+              bulk_size=BULK_SIZE, bulk_bytes=BULK_MAX_BYTES, pk_range=None, fingerprints=None, forget_index=None,
+              profile=False):
+    # fingerprints is None or (index_name, force) to only send changed documents.
+    # Otherwise fingerprints of written documents kept under forget_index are dropped.
+    # Returns the number of failed documents and, with profile, the timings of the batch.
+    timer = BatchTimer(doctype, os.getpid()) if profile else None
+    current_qs = batch_queryset(qs, start, end, pk_range)
+
+    if timer is not None:
+        # Read the rows up front so the DB is timed on its own
+        current_qs = list(current_qs)
+        timer.fetched()
+
     sqs = SQS(index.index_name, doctype, backend=backend)
 
     if verbosity >= 2:
@@ -73,15 +144,39 @@ def do_update(backend, index, doctype, qs, start, end, total, remove, verbosity=
         else:
             print("  indexed %s - %d of %d (by %s)." % (start + 1, end, total, os.getpid()))
 
-    for item in current_qs:
-        if getattr(item, index.active_field):
-            sqs.index(item.pk, item.get_search_dict())
-        elif remove:
-            sqs.remove(item.pk)
+    with sqs.bulk(bulk_size, bulk_bytes) as bulk:
+        if fingerprints is not None:
+            store = FingerprintStore(fingerprints[0], doctype, force=fingerprints[1])
+            skipped = store.update(bulk, current_qs, index.active_field, remove)
+
+            if verbosity >= 2:
+                print("  skipped %d unchanged documents." % skipped)
+        else:
+            written = []
+            for item in current_qs:
+                if getattr(item, index.active_field):
+                    bulk.index(item.pk, item.get_search_dict())
+                    written.append(item.pk)
+                elif remove:
+                    bulk.remove(item.pk)
+                    written.append(item.pk)
+
+            if forget_index is not None:
+                # Whatever was fingerprinted for these is out of date now
+                IndexFingerprint.forget(forget_index, doctype, written)
+
+    if bulk.errors:
+        print("  %d documents failed in %s - %d, see log for details." % (len(bulk.errors), start + 1, end))
 
     # Clear out the DB connections queries because it bloats up RAM.
     reset_queries()
 
+    timings = None
+    if timer is not None:
+        timings = timer.finish(len(current_qs), bulk)
+
+    return len(bulk.errors), timings
+
 
 class Command(LabelCommand):
     help = "Freshens the index for the given app"
@@ -109,8 +204,58 @@ class Command(LabelCommand):
             default=0, type='int',
             help='Allows for the use multiple workers to parallelize indexing. Requires multiprocessing.'
         ),
+        make_option('--bulk-size', action='store', dest='bulk_size',
+            default=BULK_SIZE, type='int',
+            help='Maximum number of actions sent to ES in a single bulk request.'
+        ),
+        make_option('--bulk-bytes', action='store', dest='bulk_bytes',
+            default=BULK_MAX_BYTES, type='int',
+            help='Maximum payload size in bytes of a single bulk request.'
+        ),
+        make_option('--keyset', action='store_true', dest='keyset',
+            default=False, help='Batch by primary key ranges instead of LIMIT/OFFSET slices.'
+        ),
+        make_option('--pipeline', action='store_true', dest='pipeline',
+            default=False, help='Overlap DB reads, serialization and ES writes using threads.'
+        ),
+        make_option('--serializers', action='store', dest='serializers',
+            default=1, type='int',
+            help='Number of serializer threads used with --pipeline.'
+        ),
+        make_option('--senders', action='store', dest='senders',
+            default=2, type='int',
+            help='Number of concurrent bulk senders used with --pipeline.'
+        ),
+        make_option('--queue-size', action='store', dest='queue_size',
+            default=4, type='int',
+            help='Number of batches buffered between pipeline stages.'
+        ),
+        make_option('--reconcile', action='store_true', dest='reconcile',
+            default=False, help='Remove documents from the index which have no matching row in the database.'
+        ),
+        make_option('--fingerprints', action='store_true', dest='fingerprints',
+            default=False, help='Only send documents whose search dict changed since they were last sent.'
+        ),
+        make_option('--resume', action='store_true', dest='resume',
+            default=False, help='Continue an interrupted run from its last checkpoint. Implies --keyset.'
+        ),
+        make_option('--profile', action='store_true', dest='profile',
+            default=False, help='Time every phase of every batch and report throughput.'
+        ),
+        make_option('--profile-file', action='store', dest='profile_file',
+            default=None, type='string',
+            help='Write the JSON summary of --profile to this file instead of printing it.'
+        ),
+    )
+    option_list = LabelCommand.option_list + base_options + (
+        make_option('--target-index', action='store', dest='target_index',
+            default=None, type='string',
+            help='Write into this physical index instead of the index name of the label.'
+        ),
+        make_option('--keep-checkpoints', action='store_true', dest='keep_checkpoints',
+            default=False, help='Leave the checkpoints of a finished run for whoever swaps the target index in.'
+        ),
     )
-    option_list = LabelCommand.option_list + base_options
 
     def handle(self, *items, **options):
         self.verbosity = int(options.get('verbosity', 1))
@@ -119,7 +264,43 @@ class Command(LabelCommand):
         self.end_date = None
         self.remove = options.get('remove', False)
         self.workers = int(options.get('workers', 0))
-        self.backend = Elasticsearch(settings.ELASTICSEARCH_NODES)
+        self.bulk_size = int(options.get('bulk_size') or BULK_SIZE)
+        self.bulk_bytes = int(options.get('bulk_bytes') or BULK_MAX_BYTES)
+        self.keyset = options.get('keyset', False)
+        self.target_index = options.get('target_index')
+        self.pipeline = options.get('pipeline', False)
+        self.serializers = int(options.get('serializers') or 1)
+        self.senders = int(options.get('senders') or 2)
+        self.queue_size = int(options.get('queue_size') or 4)
+        self.reconcile = options.get('reconcile', False)
+        self.fingerprints = options.get('fingerprints', False)
+        self.resume = options.get('resume', False)
+        self.keep_checkpoints = options.get('keep_checkpoints', False)
+        self.profiler = None
+        if options.get('profile'):
+            self.profiler = Profiler(self.verbosity)
+
+        if self.resume:
+            # Only primary key ranges stay put while rows come and go
+            self.keyset = True
+
+        if self.pipeline and self.workers > 0:
+            raise CommandError("--pipeline and --workers can not be used together.")
+
+        if self.fingerprints and not conf.FINGERPRINTS:
+            raise CommandError("--fingerprints needs ELASTICSEARCH_FINGERPRINTS, or other writes would leave "
+                               "fingerprints of documents they changed behind.")
+
+        if self.pipeline and self.fingerprints:
+            raise CommandError("--pipeline and --fingerprints can not be used together.")
+
+        if self.pipeline and self.resume:
+            raise CommandError("--pipeline and --resume can not be used together.")
+
+        if self.pipeline and self.profiler is not None:
+            raise CommandError("--pipeline and --profile can not be used together.")
+
+        self.backend = get_backend()
 
         age = options.get('age', DEFAULT_AGE)
         start_date = options.get('start_date')
@@ -145,12 +326,31 @@ class Command(LabelCommand):
             except ValueError:
                 pass
 
+        # --age gives another window every time, a resumed run keeps the one
+        # recorded in the checkpoint instead
+        self.relative_dates = age is not None
+
+        # Options which change what a run indexes, a checkpoint is only
+        # resumed by a run with the same ones.
+        self.checkpoint_options = json.dumps({
+            'start_date': self.start_date.isoformat() if self.start_date is not None else None,
+            'end_date': self.end_date.isoformat() if self.end_date is not None else None,
+            'remove': self.remove,
+            'fingerprints': self.fingerprints,
+            'target_index': self.target_index,
+        }, sort_keys=True)
+
         if not items:
             items = []
             for index in INDEXES.keys():
                 items.append(index)
 
-        return super(Command, self).handle(*items, **options)
+        output = super(Command, self).handle(*items, **options)
+
+        if self.profiler is not None:
+            self.profiler.write(options.get('profile_file'))
+
+        return output
 
     def handle_label(self, label, **options):
         try:
@@ -178,27 +378,207 @@ class Command(LabelCommand):
             index = INDEXES[label]()
             doc_types = index.doc_types
 
+        # Fingerprints belong to the physical index written into. A target index
+        # is being built from scratch so everything in it has to be sent, its
+        # fingerprints are moved to the index name when rebuild_index swaps it in.
+        live_name = index.index_name
+        fingerprint_index = self.target_index or live_name
+        fingerprints = None
+        if self.fingerprints:
+            fingerprints = (fingerprint_index, bool(self.target_index))
+
+        if self.target_index:
+            index.index_name = self.target_index
+
+        # Doc types with failed documents, their checkpoints stay put
+        self.failed = set()
+
         for doctype in doc_types:
-            qs = getattr(index, "%s_queryset" % doctype)(start_date=self.start_date, end_date=self.end_date)
+            checkpoint = None
+            if self.keyset and not self.pipeline:
+                checkpoint = self.get_checkpoint(live_name, doctype)
+
+                if checkpoint.done:
+                    if self.verbosity >= 1:
+                        print(u"  %s-%s was completed before, skipping." % (label, doctype))
+                    continue
+
+            start_date, end_date = self.dates(checkpoint)
+            qs = getattr(index, "%s_queryset" % doctype)(start_date=start_date, end_date=end_date)
             total = qs.count()
 
             if self.verbosity >= 1:
                 print(u"Indexing %d %s-%s" % (total, label, doctype))
 
+            if self.target_index and not self.fingerprints and conf.FINGERPRINTS:
+                # Every document gets written without fingerprints, once the
+                # alias is swapped none of the old ones can be trusted
+                IndexFingerprint.objects.filter(index_name=live_name, doc_type=doctype).delete()
+
             batch_size = self.batchsize
 
             if self.workers > 0:
                 ghetto_queue = []
 
-            for start in range(0, total, batch_size):
-                end = min(start + batch_size, total)
-
-                if self.workers == 0:
-                    do_update(self.backend, index, doctype, qs, start, end, total, self.remove, self.verbosity)
-                else:
-                    ghetto_queue.append((index, doctype, start, end, total, self.start_date, self.end_date, self.remove, self.verbosity))
+            if checkpoint is not None:
+                batches = self.keyset_batches(qs, batch_size, total, checkpoint.last_pk)
+            elif self.keyset:
+                batches = self.keyset_batches(qs, batch_size, total)
+            else:
+                batches = ((start, min(start + batch_size, total), None) for start in range(0, total, batch_size))
+
+            profile = self.profiler is not None
+            if profile:
+                self.profiler.start(doctype)
+
+            if self.pipeline:
+                self.run_pipeline(index, doctype, qs, batches, total, fingerprint_index)
+            else:
+                for start, end, pk_range in batches:
+                    if self.workers == 0:
+                        result = do_update(self.backend, index, doctype, qs, start, end, total, self.remove,
+                                           self.verbosity, self.bulk_size, self.bulk_bytes, pk_range, fingerprints,
+                                           fingerprint_index, profile)
+                        self.batch_done(checkpoint, doctype, pk_range, result)
+                    else:
+                        ghetto_queue.append(Batch(index, doctype, start, end, total, start_date, end_date,
+                                                  self.remove, self.verbosity, self.bulk_size, self.bulk_bytes,
+                                                  pk_range, fingerprints, fingerprint_index, profile))
 
             if self.workers > 0:
                 pool = multiprocessing.Pool(self.workers)
-                pool.map(worker, ghetto_queue)
+                # Results come back in queue order, so every batch before
+                # the current one is done as well.
+                for position, result in enumerate(pool.imap(worker, ghetto_queue)):
+                    self.batch_done(checkpoint, doctype, ghetto_queue[position].pk_range, result)
                 pool.terminate()
+
+            if profile:
+                self.profiler.finish(doctype)
+
+            if self.reconcile:
+                self.remove_orphans(index, doctype, fingerprint_index)
+
+            if checkpoint is not None and doctype not in self.failed:
+                checkpoint.finish()
+            elif checkpoint is not None and self.verbosity >= 1:
+                print(u"  %s-%s had failed documents, run with --resume to send them again." % (label, doctype))
+
+        if self.keyset and not self.pipeline and not self.failed and not self.keep_checkpoints:
+            # Everything went through, the next run starts from scratch
+            IndexCheckpoint.objects.filter(index_name=live_name, doc_type__in=doc_types,
+                                           target_index=self.target_index or '').delete()
+
+    def run_pipeline(self, index, doctype, qs, batches, total, forget_index):
+        pipeline = IndexingPipeline(self.backend, index, doctype, self.remove, self.serializers, self.senders,
+                                    self.queue_size, self.bulk_size, self.bulk_bytes, total, self.verbosity,
+                                    forget_index)
+        errors = pipeline.run(batch_queryset(qs, start, end, pk_range) for start, end, pk_range in batches)
+
+        if errors:
+            print("  %d documents failed in %s-%s, see log for details." % (len(errors), index.index_name, doctype))
+
+    def remove_orphans(self, index, doctype, fingerprint_index):
+        """
+        Removes documents whose row is gone from the full queryset of doctype,
+        whatever the dates the run was limited to
+        """
+        qs = getattr(index, "%s_queryset" % doctype)(start_date=None, end_date=None)
+        sqs = SQS(index.index_name, doctype, backend=self.backend)
+        orphans = []
+
+        with sqs.bulk(self.bulk_size, self.bulk_bytes) as bulk:
+            for doc_id in find_orphans(self.backend, index, doctype, qs):
+                bulk.remove(doc_id)
+                orphans.append(doc_id)
+
+        IndexFingerprint.forget(fingerprint_index, doctype, orphans)
+
+        if self.verbosity >= 1:
+            print(u"Removed %d orphaned %s-%s" % (bulk.removed, index.index_name, doctype))
+
+        if bulk.errors:
+            print("  %d documents failed to be removed, see log for details." % len(bulk.errors))
+
+    def batch_done(self, checkpoint, doctype, pk_range, result):
+        """
+        Records a batch which went through in the checkpoint and the profile.
+        The checkpoint is not moved past a batch with failed documents, nor
+        past any later one, so resuming sends them again
+        """
+        errors, timings = result
+        if errors:
+            self.failed.add(doctype)
+
+        if checkpoint is not None and doctype not in self.failed:
+            checkpoint.advance(pk_range[1])
+
+        if timings is not None:
+            self.profiler.add(timings)
+
+    def get_checkpoint(self, index_name, doctype):
+        """
+        Returns the checkpoint of index_name/doctype. It is started over unless
+        the run resumes, in which case it has to come from a run with the same options
+        """
+        checkpoint, created = IndexCheckpoint.objects.get_or_create(
+            index_name=index_name, doc_type=doctype, target_index=self.target_index or '',
+            defaults={'options': self.checkpoint_options, 'modified': now()})
+
+        if created:
+            return checkpoint
+
+        if not self.resume:
+            checkpoint.options = self.checkpoint_options
+            checkpoint.last_pk = None
+            checkpoint.done = False
+            checkpoint.modified = now()
+            checkpoint.save()
+        elif not self.same_options(checkpoint.options):
+            raise CommandError("The checkpoint of %s-%s was recorded with other options (%s), "
+                               "run without --resume to start over." % (index_name, doctype, checkpoint.options))
+        elif self.verbosity >= 1 and checkpoint.last_pk is not None:
+            print(u"  resuming %s-%s after pk %s." % (index_name, doctype, checkpoint.last_pk))
+
+        return checkpoint
+
+    def same_options(self, options):
+        """
+        Returns whether checkpoint options were recorded by a run like this one
+        """
+        recorded = json.loads(options)
+        current = json.loads(self.checkpoint_options)
+
+        if self.relative_dates:
+            for key in ('start_date', 'end_date'):
+                recorded.pop(key, None)
+                current.pop(key, None)
+
+        return recorded == current
+
+    def dates(self, checkpoint):
+        """
+        Returns the start and end date of the rows to index, a checkpoint
+        brings those of the run which recorded it
+        """
+        if checkpoint is None:
+            return self.start_date, self.end_date
+
+        from dateutil.parser import parse as dateutil_parse
+
+        options = json.loads(checkpoint.options)
+        return tuple(dateutil_parse(options[key]) if options.get(key) else None for key in ('start_date', 'end_date'))
+
+    def keyset_batches(self, qs, batch_size, total, after_pk=None):
+        """
+        Yields ``(start, end, pk_range)`` for every primary key range of the queryset.
+        ``start`` and ``end`` are only approximate positions used for progress output.
+        """
+        start = 0
+        if after_pk is not None:
+            start = qs.filter(pk__lte=after_pk).count()
+
+        for pk_range in keyset_ranges(qs, batch_size, after_pk):
+            end = min(start + batch_size, total)
+            yield start, end, pk_range
+            start = end
@@ -1,14 +1,136 @@
 import six
+import copy
 import json
+import logging
 
-from search.query import Query
+from django.db import models
+
+from elasticsearch import TransportError, NotFoundError
+
+try:
+    from django.utils.timezone import now
+except ImportError:
+    from datetime import datetime
+    now = datetime.now
+
+from search.query import Query, encode_cursor, decode_cursor
+from search.constants import MLT_CURSOR
+from search.bulk import BulkIndexer
+from search.cache import SparseResultCache, make_key
+from search.signals import index_updated
+from search.instrumentation import measure
+from search import serializers
 from search import conf
 
 
+log = logging.getLogger(__name__)
+
+
+def msearch(sqs_list, start=0, end=None):
+    """
+    Runs many SQS in a single round trip through the ES Multi Search Api.
+    Results from ``start`` to ``end`` of every SQS are fetched and cached on it,
+    along with counts, facets and suggestions, so reading them afterwards does not
+    hit ES again. More like this queries and queries whose slot came back with
+    an error are left to run on their own when they are accessed
+    """
+    if any(sqs.is_async for sqs in sqs_list):
+        raise TypeError("AsyncSQS has to be run with search.aio.msearch")
+
+    pending = prepare_msearch(sqs_list, start, end)
+
+    if pending:
+        request = get_msearch_body(pending)
+        with measure("msearch", get_msearch_index(pending)) as measurement:
+            response = pending[0][0].backend.msearch(body=request)
+            measurement.set_response(response)
+
+        set_msearch_response(pending, start, response)
+
+    return sqs_list
+
+
+def prepare_msearch(sqs_list, start=0, end=None):
+    """
+    Limits every SQS to results from start to end and fills those whose response
+    is in the query cache. Returns (sqs, body, params) of the ones left to search
+    """
+    if end is None:
+        end = start + conf.SIZE_PER_QUERY
+
+    pending = []
+    for sqs in sqs_list:
+        sqs.query._reset()
+        sqs.query.set_limits(start, end)
+
+        if sqs.query.mlt_query:
+            continue
+
+        body, params = sqs.query.prepare()
+        results = sqs.query.get_cached_response(body, params)
+
+        if results is not None:
+            sqs.set_response(start, results)
+        else:
+            pending.append((sqs, body, params))
+
+    return pending
+
+
+def get_msearch_body(pending):
+    """
+    Returns the Multi Search Api request body of queries left by prepare_msearch
+    """
+    request = []
+    for sqs, body, params in pending:
+        request.extend(sqs.query.get_msearch_request(body, params))
+    return request
+
+
+def get_msearch_index(pending):
+    return ",".join(sorted(set(sqs.index_name for sqs, body, params in pending)))
+
+
+def set_msearch_response(pending, start, response):
+    """
+    Hands every response of a Multi Search Api response to its SQS and caches it
+    """
+    for (sqs, body, params), results in zip(pending, response['responses']):
+        if 'error' in results:
+            log.warning("Multi search failed for %s/%s: %s", sqs.index_name, sqs.doc_type, results['error'])
+            continue
+
+        sqs.set_response(start, sqs.query.cache_response(body, params, results))
+
+
+def get_model_queryset(index_name, doc_type):
+    """
+    Returns a queryset of the model behind doc_type of index_name, going by the
+    querysets of the index definitions in conf.INDEXES, or None if there is none
+    """
+    candidates = sorted(conf.INDEXES.values(), key=lambda index_class: index_class.index_name != index_name)
+
+    for index_class in candidates:
+        get_queryset = getattr(index_class(), "%s_queryset" % doc_type, None)
+        if get_queryset is not None:
+            return get_queryset(start_date=None, end_date=None).model._default_manager.all()
+
+    return None
+
+
 class SQS(object):
     """
     Search Queryset Class
     """
+    query_class = Query
+    result_class = None
+    values_fields = None
+    values_flat = False
+    # (select_related, prefetch_related) when results get their model instances
+    model_loading = None
+    # Whether the backend returns awaitables, see search.aio
+    is_async = False
+
     def __init__(self, index_name, doc_type=None, query=None, backend=None, process_results=True):
         self.index_name = index_name
         self.doc_type = doc_type
@@ -17,17 +139,23 @@ class SQS(object):
         if backend is not None:
             self.backend = backend
         else:
-            from search import es
-            self.backend = es
+            self.backend = self.get_default_backend()
 
         if query is not None:
             self.query = query
         else:
-            self.query = Query(index_name, doc_type, self.backend)
+            self.query = self.query_class(index_name, doc_type, self.backend)
 
-        self._result_cache = []
+        self._result_cache = SparseResultCache()
         self._result_count = None
 
+    def get_default_backend(self):
+        """
+        Returns ES client used when no backend is passed
+        """
+        from search.connection import get_backend
+        return get_backend()
+
     def __repr__(self):
         """
         Representation of SQS object. Called when object is accessed/printed.
@@ -55,7 +183,7 @@ class SQS(object):
         """
         if self._cache_is_full():
             # We've got a fully populated cache. Let Python do the hard work.
-            return iter(self._result_cache)
+            return iter(self._result_cache.slice(0, len(self)))
 
         return self._manual_iter()
 
@@ -89,8 +217,12 @@ class SQS(object):
             start = k
             bound = k + 1
 
+        # Nothing past the last result can ever be cached.
+        if self._result_count is not None:
+            bound = min(bound, self._result_count)
+
         # We need check to see if we need to populate more of the cache.
-        if len(self._result_cache) <= 0 or (None in self._result_cache[start:bound] and not self._cache_is_full()):
+        if not self._result_cache.is_cached(start, bound) and not self._cache_is_full():
             try:
                 self._fill_cache(start, bound)
             except StopIteration:
@@ -99,9 +231,9 @@ class SQS(object):
 
         # Cache should be full enough for our needs.
         if is_slice:
-            return self._result_cache[start:bound]
+            return self._result_cache.slice(start, bound)
         else:
-            return self._result_cache[start]
+            return self._result_cache.get(start)
 
     def _cache_is_full(self):
         """
@@ -113,12 +245,7 @@ class SQS(object):
         if len(self) <= 0:
             return True
 
-        try:
-            self._result_cache.index(None)
-            return False
-        except ValueError:
-            # No ``None``s found in the results. Check the length of the cache.
-            return len(self._result_cache) > 0
+        return self._result_cache.is_cached(0, len(self))
 
     def _manual_iter(self):
         # If we're here, our cache isn't fully populated.
@@ -126,26 +253,19 @@ class SQS(object):
         # Also, this can't be part of the __iter__ method due to Python's rules
         # about generator functions.
         current_position = 0
-        current_cache_max = 0
 
         while True:
-            if len(self._result_cache) > 0:
-                try:
-                    current_cache_max = self._result_cache.index(None)
-                except ValueError:
-                    current_cache_max = len(self._result_cache)
-
-            while current_position < current_cache_max:
-                yield self._result_cache[current_position]
+            for result in self._result_cache.slice(current_position):
+                yield result
                 current_position += 1
 
             if self._cache_is_full():
-                raise StopIteration
+                return
 
             # We've run out of results and haven't hit our limit.
             # Fill more of the cache.
             if not self._fill_cache(current_position, current_position + conf.SIZE_PER_QUERY):
-                raise StopIteration
+                return
 
     def _fill_cache(self, start, end, **kwargs):
         # Tell the query where to start from and how many we'd like.
@@ -156,56 +276,202 @@ class SQS(object):
         if results == None or len(results) == 0:
             return False
 
-        # Setup the full cache now that we know how many results there are.
-        # We need the ``None``s as placeholders to know what parts of the
-        # cache we have/haven't filled.
-        # Using ``None`` like this takes up very little memory. In testing,
-        # an array of 100,000 ``None``s consumed less than .5 Mb, which ought
-        # to be an acceptable loss for consistent and more efficient caching.
-        if len(self._result_cache) == 0:
-            self._result_cache = [None for i in range(self.query.get_count())]
+        self._cache_results(start or 0, results)
+        return True
+
+    def _cache_results(self, start, results):
+        # The count came back with the results, remember it instead of
+        # asking the query again later.
+        self._result_count = self.query._hit_count
 
-        if start is None:
-            start = 0
+        # Only what was fetched is stored, the cache never grows with the
+        # total number of hits.
+        self._result_cache.add(start, self.post_process_results(results))
+
+    def set_response(self, start, results):
+        """
+        Fills query and result cache from a search response fetched elsewhere,
+        results in it begin at offset start
+        """
+        self.query.set_response(results)
+        if self.query._results:
+            self._cache_results(start, self.query._results)
+
+    def iterator(self, chunk_size=None, scroll=None):
+        """
+        Streams every result of the query using the ES Scroll Api, fetching
+        ``chunk_size`` hits per request. Results are not stored in the result cache,
+        so this keeps memory constant while walking very large result sets
+        """
+        chunk_size = chunk_size or conf.SCROLL_SIZE
+        scroll = scroll or conf.SCROLL_TIMEOUT
 
+        chunks = self.query.scan(chunk_size, scroll)
+        try:
+            for hits in chunks:
+                for result in self.post_process_results(hits):
+                    yield result
+        finally:
+            chunks.close()
+
+    def scan(self):
+        """
+        Streams every result of the query using the ES Scroll Api
+        """
+        return self.iterator()
+
+    def iter_json(self, start=None, end=None, chunk_size=None):
+        """
+        Yields results as a JSON array in pieces of encoded bytes, one result at a time,
+        ready to be handed to a streaming response. Hits are encoded straight from the
+        ES response without building result objects. Without start and end the whole
+        result set is streamed using the Scroll Api
+        """
+        if start is None and end is None:
+            chunks = self.query.scan(chunk_size or conf.SCROLL_SIZE, conf.SCROLL_TIMEOUT)
+        else:
+            chunks = self._raw_page(start or 0, end)
+
+        chunks = (self._json_items(hits) for hits in chunks)
+        for piece in serializers.iter_json(chunks, self._json_encoder()):
+            yield piece
+
+    def _json_items(self, hits):
+        # Items of a chunk of hits which _json_encoder encodes
+        if self.values_fields is not None:
+            return self.process_values(hits)
+        return hits
+
+    def _json_encoder(self):
+        if self.values_fields is not None:
+            return serializers.dumps
+        elif self.process_results:
+            return lambda hit: serializers.hit_to_json(self.index_name, hit)
+        else:
+            return lambda hit: serializers.dumps(dict(hit.get('fields') or hit.get('_source'), doc_type=hit['_type']))
+
+    def _raw_page(self, start, end=None):
+        # Raw hits of a single page, the result cache is left alone
+        yield self._raw_page_query(start, end).get_results() or []
+
+    def _raw_page_query(self, start, end=None):
+        # A copy of the query, so results fetched by this SQS stay where they are
         if end is None:
-            end = self.query.get_count()
+            end = start + conf.SIZE_PER_QUERY
 
-        to_cache = self.post_process_results(results)
+        query = self.query.clone()
+        query.set_limits(start, end)
+        return query
 
-        # Assign by slice.
-        self._result_cache[start:start + len(to_cache)] = to_cache
-        return True
+    def page(self, cursor=None, size=None):
+        """
+        Returns a page of ``size`` results following ``cursor`` along with the cursor
+        of the next page, which is ``None`` on the last page. Pages are fetched
+        with search_after instead of from/size, so deep pages cost the same as the
+        first one. Pass ``None`` as cursor to get the first page
+        """
+        size = size or conf.SIZE_PER_QUERY
+        results = self._page_query(cursor, size).get_results()
+        return self._page_results(results, size)
+
+    def _page_query(self, cursor, size):
+        # A copy of the query limited to the page after cursor, so paging
+        # leaves the results of this SQS alone
+        if self.query.mlt_query:
+            raise ValueError(MLT_CURSOR)
+
+        sort_values = decode_cursor(cursor) if cursor is not None else []
+
+        query = self.query.clone()
+        query.set_limits(0, size)
+        query.set_search_after(sort_values)
+        return query
+
+    def _page_results(self, results, size):
+        next_cursor = None
+        if len(results) == size:
+            next_cursor = encode_cursor(results[-1]['sort'])
+
+        return self.post_process_results(results), next_cursor
 
     def post_process_results(self, results):
         """
-        Converts list of dictionary of results into list of SearchResult objects
+        Converts list of dictionary of results into list of SearchResult objects,
+        or tuples of values when values_list was asked for
         """
+        if self.values_fields is not None:
+            return self.process_values(results)
+
+        result_class = self.result_class or SearchResult
         results_list = []
         for result in results:
-            if result.get('fields'):
-                if self.process_results:
-                    results_list.append(SearchResult(self.index_name, result['_type'], result['_id'], result['_score'], result.get('fields')))
-                else:
-                    data = result.get('fields').copy()
-                    data['doc_type'] = result['_type']
-                    results_list.append(data)
+            if self.process_results:
+                results_list.append(result_class.from_hit(self.index_name, result))
             else:
-                if self.process_results:
-                    results_list.append(SearchResult(self.index_name, result['_type'], result['_id'], result['_score'], result.get('_source')))
-                else:
-                    data = result.get('_source').copy()
-                    data['doc_type'] = result['_type']
-                    results_list.append(data)
+                data = (result.get('fields') or result.get('_source')).copy()
+                data['doc_type'] = result['_type']
+                results_list.append(data)
+
+        if self.model_loading is not None and self.process_results:
+            self.load_objects(results_list)
 
         return results_list
 
-    def _clone(self):
+    def load_objects(self, results):
+        """
+        Attaches model instances to results with one query per doc_type
+        """
+        select_related, prefetch_related = self.model_loading
+        pks = {}
+        for result in results:
+            pks.setdefault(result.doc_type, []).append(result.pk)
+
+        objects = {}
+        for doc_type, doc_pks in pks.items():
+            qs = get_model_queryset(self.index_name, doc_type)
+            if qs is None:
+                continue
+
+            if select_related:
+                qs = qs.select_related(*select_related)
+            if prefetch_related:
+                qs = qs.prefetch_related(*prefetch_related)
+
+            objects[doc_type] = dict((str(pk), obj) for pk, obj in qs.in_bulk(doc_pks).items())
+
+        for result in results:
+            result._object = objects.get(result.doc_type, {}).get(str(result.pk))
+
+    def process_values(self, results):
+        """
+        Picks values of requested fields out of every hit. ``pk``, ``doc_type``
+        and ``score`` give the document id, type and score
+        """
+        fields = self.values_fields
+        values_list = []
+
+        for result in results:
+            body = result.get('fields') or result.get('_source') or {}
+            meta = {'pk': result['_id'], 'doc_type': result['_type'], 'score': result.get('_score')}
+            values = tuple(meta[field] if field in meta else body.get(field) for field in fields)
+            values_list.append(values[0] if self.values_flat else values)
+
+        return values_list
+
+    def _clone(self, query=None):
         """
-        Creates a new instance of SQS and assigns it existing query
-        and returns this instance. This makes the queryset chainable
+        Creates a new instance of SQS with the given query node, or a fresh
+        clone of the existing one, and returns this instance. This makes the
+        queryset chainable without chained querysets affecting each other
         """
-        clone = SQS(self.index_name, self.doc_type, self.query, self.backend, self.process_results)
+        if query is None:
+            query = self.query.clone()
+
+        clone = self.__class__(self.index_name, self.doc_type, query, self.backend, self.process_results)
+        clone.result_class = self.result_class
+        clone.values_fields = self.values_fields
+        clone.values_flat = self.values_flat
+        clone.model_loading = self.model_loading
         return clone
 
     def create_index(self, body):
@@ -264,9 +530,10 @@ class SQS(object):
 
     def show_query(self):
         """
-        Displays Query DSL created so far
+        Displays Query DSL created so far. The query is shared between chained
+        querysets, so this is a copy which can be changed freely
         """
-        return self.query.build_query()
+        return copy.deepcopy(self.query.build_query())
 
     def reset(self):
         """
@@ -280,78 +547,222 @@ class SQS(object):
         """
         Create or Update a document in index
         """
-        return self.backend.index(self.index_name, self.doc_type, doc_body, doc_id)
+        with measure("index", self.index_name, self.doc_type) as measurement:
+            result = self.backend.index(self.index_name, self.doc_type, doc_body, doc_id)
+            measurement.set_response(result)
+
+        IndexFingerprint.forget(self.index_name, self.doc_type, [doc_id])
+        index_updated.send(sender=SQS, index_name=self.index_name)
+        return result
 
     def remove(self, doc_id):
         """
         Remove the specified document
         """
         try:
-            return self.backend.delete(self.index_name, self.doc_type, doc_id)
+            with measure("delete", self.index_name, self.doc_type) as measurement:
+                result = self.backend.delete(self.index_name, self.doc_type, doc_id)
+                measurement.set_response(result)
+            return result
         except:
             return None
+        finally:
+            IndexFingerprint.forget(self.index_name, self.doc_type, [doc_id])
+            index_updated.send(sender=SQS, index_name=self.index_name)
+
+    def bulk(self, max_actions=None, max_bytes=None):
+        """
+        Returns a BulkIndexer to create, update or remove many documents of
+        this index/doc_type in as few requests as possible
+        """
+        return BulkIndexer(self.backend, self.index_name, self.doc_type, max_actions, max_bytes)
 
     def get(self, doc_id, fields=None):
         """
         Get specified document
         """
         try:
-            if fields:
-                result = self.backend.get(self.index_name, doc_id, self.doc_type, fields=fields)
-                if self.process_results:
-                    return SearchResult(self.index_name, self.doc_type, result['_id'], 0, result.get('fields'))
-                else:
-                    return result.get('fields')
-            else:
-                result = self.backend.get(self.index_name, doc_id, self.doc_type)
-                if self.process_results:
-                    return SearchResult(self.index_name, self.doc_type, result['_id'], 0, result.get('_source'))
+            with measure("get", self.index_name, self.doc_type) as measurement:
+                if fields:
+                    result = self.backend.get(self.index_name, doc_id, self.doc_type, fields=fields)
                 else:
-                    return result.get('_source')
-        except:
+                    result = self.backend.get(self.index_name, doc_id, self.doc_type)
+                measurement.set_response(result)
+            return self.process_document(result, fields)
+        except NotFoundError:
+            # Anything else, like ES being unreachable, is not a missing document
             return None
 
+    def get_many(self, ids, fields=None, source_include=None, source_exclude=None):
+        """
+        Get many documents in a single hit to ES Multi Get Api. Returns a list in
+        the order of ids, with None for every document which does not exist.
+        Documents are read through the shared query cache when it is enabled.
+        A document ES failed to get, e.g. because its shard is unavailable, raises
+        TransportError once the others are cached
+        """
+        params = self._mget_params(fields, source_include, source_exclude)
+        docs, missing = self._cached_docs(ids, params)
+
+        if missing:
+            body = {"ids": missing}
+            with measure("mget", self.index_name, self.doc_type) as measurement:
+                response = self.backend.mget(body=body, index=self.index_name, doc_type=self.doc_type, **params)
+                measurement.set_response(response)
+
+            self._cache_docs(docs, response, params)
+
+        return self._process_docs(ids, docs, fields)
+
+    def _mget_params(self, fields=None, source_include=None, source_exclude=None):
+        params = {}
+        if fields:
+            params['fields'] = list(fields)
+        if source_include:
+            params['_source_include'] = list(source_include)
+        if source_exclude:
+            params['_source_exclude'] = list(source_exclude)
+        return params
+
+    def _mget_cache_key(self, doc_id, params):
+        return make_key(self.index_name, self.doc_type, {"mget": doc_id}, params)
+
+    def _cached_docs(self, ids, params):
+        # Documents of ids found in the query cache, by id, and the ids left
+        # to fetch
+        cache = self.query.get_cache()
+        docs = {}
+
+        if cache is not None:
+            for doc_id in set(str(doc_id) for doc_id in ids):
+                doc = cache.get(self.index_name, self._mget_cache_key(doc_id, params))
+                if doc is not None:
+                    docs[doc_id] = doc
+
+        missing = []
+        for doc_id in ids:
+            doc_id = str(doc_id)
+            if doc_id not in docs and doc_id not in missing:
+                missing.append(doc_id)
+
+        return docs, missing
+
+    def _cache_docs(self, docs, response, params):
+        cache = self.query.get_cache()
+
+        for doc in response.get('docs', []):
+            docs[doc['_id']] = doc
+            # Documents which are not found are cached too, creating one
+            # invalidates the cache of its index. Failures are not.
+            if cache is not None and 'error' not in doc:
+                cache.set(self.index_name, self._mget_cache_key(doc['_id'], params), doc)
+
+    def _process_docs(self, ids, docs, fields=None):
+        results = []
+        for doc_id in ids:
+            doc = docs.get(str(doc_id))
+            if doc is not None and 'error' in doc:
+                raise TransportError('N/A', doc['error'], doc)
+            elif doc is None or not doc.get('found'):
+                results.append(None)
+            else:
+                results.append(self.process_document(doc, fields))
+
+        return results
+
+    def process_document(self, result, fields=None):
+        """
+        Converts a document returned by Get Api into a SearchResult
+        """
+        data = result.get('fields') if fields else result.get('_source')
+
+        if self.process_results:
+            return SearchResult(self.index_name, self.doc_type, result['_id'], 0, data)
+        else:
+            return data
+
     def search(self, content, search_fields=None):
         """
         Add main search query using user entered text terms
         """
-        clone = self._clone()
-        clone.query.add_search_query(content, search_fields)
-        return clone
+        return self._clone(self.query.add_search_query(content, search_fields))
 
     def filter(self, **kwargs):
         """
         Add filter query
         """
-        clone = self._clone()
         if conf.DEFAULT_FILTER == "AND":
-            clone.query.add_filter_and(kwargs)
+            return self._clone(self.query.add_filter_and(kwargs))
         else:
-            clone.query.add_filter_or(kwargs)
-        return clone
+            return self._clone(self.query.add_filter_or(kwargs))
 
     def filter_and(self, **kwargs):
         """
         Add AND Filter query
         """
-        clone = self._clone()
-        clone.query.add_filter_and(kwargs)
-        return clone
+        return self._clone(self.query.add_filter_and(kwargs))
 
     def filter_or(self, **kwargs):
         """
         Add OR Filter query
         """
-        clone = self._clone()
-        clone.query.add_filter_or(kwargs)
-        return clone
+        return self._clone(self.query.add_filter_or(kwargs))
 
     def only(self, *fields):
         """
         Restrict query to send only requested fields in response
         """
+        return self._clone(self.query.add_fields(fields))
+
+    def source(self, include=None, exclude=None):
+        """
+        Restrict the _source of every hit to fields matching include patterns
+        and not matching exclude patterns
+        """
+        source = {}
+        if include:
+            source['include'] = list(include)
+        if exclude:
+            source['exclude'] = list(exclude)
+        return self._clone(self.query.add_source(source or None))
+
+    def lazy(self):
+        """
+        Return results as LazySearchResult objects, which keep the raw hit and
+        read attributes out of it on access instead of copying every field
+        """
         clone = self._clone()
-        clone.query.add_fields(fields)
+        clone.result_class = LazySearchResult
+        return clone
+
+    def load_models(self, select_related=None, prefetch_related=None):
+        """
+        Returns a new SQS whose results carry their model instance as ``result.model_object``,
+        None where the row is gone. Every fetched page of results costs one query per
+        doc_type, the model of which comes from the index definition in conf.INDEXES
+        """
+        clone = self._clone()
+        clone.model_loading = (tuple(select_related or ()), tuple(prefetch_related or ()))
+        return clone
+
+    def values_list(self, *fields, **kwargs):
+        """
+        Return tuples of values of the given fields instead of SearchResult objects.
+        With ``flat=True`` and a single field, return the values themselves
+        """
+        flat = kwargs.pop('flat', False)
+        if flat and len(fields) != 1:
+            raise TypeError("'flat' is not valid when values_list is called with more than one field.")
+
+        if self.query.source is None and not self.query.params.get('fields'):
+            # Only the requested document fields have to come back
+            doc_fields = [field for field in fields if field not in ('pk', 'doc_type', 'score')]
+            clone = self._clone(self.query.add_source({"include": doc_fields} if doc_fields else False))
+        else:
+            clone = self._clone()
+
+        clone.values_fields = fields
+        clone.values_flat = flat
         return clone
 
     def sort(self, *args):
@@ -361,51 +772,47 @@ class SQS(object):
         in which you specify fields. Also to sort in descending order on a field
         just specify '-' sign before field name.
         """
-        clone = self._clone()
-        clone.query.add_sort(args)
-        return clone
+        return self._clone(self.query.add_sort(args))
 
     def raw_query(self, query):
         """
         Add raw query to main query dsl. This method expects a query in the form
         of a dictionary which gets updated to 'query' part of final request body
         """
-        clone = self._clone()
-        clone.query.add_raw_query(query)
-        return clone
+        return self._clone(self.query.add_raw_query(query))
 
     def raw_params(self, params):
         """
         Add raw params to final query. This method expects a query in the form
         of a dictionary which gets updated at the root of query dsl
         """
-        clone = self._clone()
-        clone.query.add_raw_params(params)
-        return clone
+        return self._clone(self.query.add_raw_params(params))
 
     def function_score(self, query):
         """
         Add function score query to final query
         """
-        clone = self._clone()
-        clone.query.add_function_score(query)
-        return clone
+        return self._clone(self.query.add_function_score(query))
 
     def facet(self, field, **kwargs):
         """
         Add facet for passed field. Adds terms facet to query
         """
-        clone = self._clone()
-        clone.query.add_term_facet(field, **kwargs)
-        return clone
+        return self._clone(self.query.add_term_facet(field, **kwargs))
 
     def facet_filter(self, field, **filter_query):
         """
         Adds facet filter to a facet query. If field is not defined as facet earlier
         then this will also add it as a facet query
         """
+        return self._clone(self.query.add_term_facet_filter(field, **filter_query))
+
+    def no_cache(self):
+        """
+        Bypass the shared query cache and always hit ES for this query
+        """
         clone = self._clone()
-        clone.query.add_term_facet_filter(field, **filter_query)
+        clone.query.use_cache = False
         return clone
 
     def count(self):
@@ -428,9 +835,7 @@ class SQS(object):
         missing in index. Can be used to override main query and run correct query and send
         out results.
         """
-        clone = self._clone()
-        clone.query.add_suggestion(suggest_text, suggest_field, suggest_mode, suggest_size)
-        return clone
+        return self._clone(self.query.add_suggestion(suggest_text, suggest_field, suggest_mode, suggest_size))
 
     def get_suggestions(self):
         """
@@ -444,18 +849,20 @@ class SQS(object):
         Return autocomplete results using ES Completion Suggester. This method
         makes a hit to ES everytime its called
         """
-        body = {"suggest":{"text":querystring, "completion":{"field":autocomplete_field, "fuzzy":True, "size":size}}}
-        resp = self.backend.suggest(body=body)
+        with measure("suggest", self.index_name) as measurement:
+            resp = self.backend.suggest(body=self._autocomplete_body(querystring, autocomplete_field, size))
+            measurement.set_response(resp)
         return resp
 
+    def _autocomplete_body(self, querystring, autocomplete_field, size):
+        return {"suggest":{"text":querystring, "completion":{"field":autocomplete_field, "fuzzy":True, "size":size}}}
+
     def mlt(self, docid, fields=None, **kwargs):
         """
         Return similar documents matching the specified docid. If fields are specified
         then matching is done using these fields only
         """
-        clone = self._clone()
-        clone.query.mlt(docid, fields, **kwargs)
-        return clone
+        return self._clone(self.query.mlt(docid, fields, **kwargs))
 
 
 class SearchResult(object):
@@ -473,6 +880,21 @@ class SearchResult(object):
             if not key in self.__dict__:
                 self.__dict__[key] = val
 
+    @classmethod
+    def from_hit(cls, index_name, hit):
+        """
+        Builds a result out of a search hit
+        """
+        return cls(index_name, hit['_type'], hit['_id'], hit.get('_score'), hit.get('fields') or hit.get('_source'))
+
+    @property
+    def model_object(self):
+        """
+        Model instance of the result, see SQS.load_models. A document field of
+        the same name is hidden by it, unlike any other field name
+        """
+        return self.__dict__.get('_object')
+
     def __repr__(self):
         return "<SearchResult: %s.%s (pk=%r)>" % (self.index_name, self.doc_type, self.pk)
 
@@ -490,9 +912,181 @@ class SearchResult(object):
         return ret_dict
 
 
+class LazySearchResult(object):
+    """
+    A single Search Result which holds on to the raw hit. Fields are looked up
+    in it when accessed, nothing is copied when the result is created
+    """
+    __slots__ = ('index_name', '_hit', '_object')
+
+    def __init__(self, index_name, hit):
+        self.index_name = index_name
+        self._hit = hit
+        self._object = None
+
+    @classmethod
+    def from_hit(cls, index_name, hit):
+        return cls(index_name, hit)
+
+    @property
+    def doc_type(self):
+        return self._hit['_type']
+
+    @property
+    def pk(self):
+        return self._hit['_id']
+
+    @property
+    def score(self):
+        return self._hit.get('_score')
+
+    @property
+    def model_object(self):
+        return self._object
+
+    def _body(self):
+        return self._hit.get('fields') or self._hit.get('_source') or {}
+
+    def __getattr__(self, name):
+        # Only called when regular lookup fails, i.e. for document fields
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        try:
+            return self._body()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __repr__(self):
+        return "<SearchResult: %s.%s (pk=%r)>" % (self.index_name, self.doc_type, self.pk)
+
+    def __unicode__(self):
+        return self.__repr__()
+
+    def __getstate__(self):
+        return {'index_name': self.index_name, '_hit': self._hit, '_object': self._object}
+
+    def __setstate__(self, state):
+        self.index_name = state['index_name']
+        self._hit = state['_hit']
+        self._object = state.get('_object')
+
+    def to_dict(self):
+        """
+        Returns the same dictionary a SearchResult would hold
+        """
+        data = {'index_name': self.index_name, 'doc_type': self.doc_type, 'pk': self.pk, 'score': self.score}
+        for key, val in self._body().items():
+            if key not in data:
+                data[key] = val
+        return data
+
+
 class SearchEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, SearchResult):
-            return obj.__dict__.copy()
+            data = obj.__dict__.copy()
+            data.pop('_object', None)
+            return data
+
+        if isinstance(obj, LazySearchResult):
+            return obj.to_dict()
 
         return json.JSONEncoder.default(self, obj)
+
+
+class IndexOutbox(models.Model):
+    """
+    Documents waiting to be sent to ES after their model instance was saved or
+    deleted. There is at most one row per document, so any number of changes
+    to an object before the outbox is drained end up as a single write
+    """
+    index_name = models.CharField(max_length=100)
+    doc_type = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=64)
+    modified = models.DateTimeField(db_index=True)
+
+    class Meta:
+        unique_together = (('index_name', 'doc_type', 'object_pk'),)
+
+    def __unicode__(self):
+        return u"%s.%s (pk=%s)" % (self.index_name, self.doc_type, self.object_pk)
+
+    @classmethod
+    def enqueue(cls, index_name, doc_type, object_pk):
+        """
+        Marks a document as changed, collapsing with a pending entry if there is one
+        """
+        entry, created = cls.objects.get_or_create(index_name=index_name, doc_type=doc_type, object_pk=str(object_pk),
+                                                   defaults={'modified': now()})
+        if not created:
+            cls.objects.filter(pk=entry.pk).update(modified=now())
+
+
+class IndexFingerprint(models.Model):
+    """
+    Hash of the search dict last sent to ES for a document. Documents whose
+    search dict hashes the same need not be sent again
+    """
+    index_name = models.CharField(max_length=100)
+    doc_type = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=64)
+    fingerprint = models.CharField(max_length=40)
+
+    class Meta:
+        unique_together = (('index_name', 'doc_type', 'object_pk'),)
+
+    def __unicode__(self):
+        return u"%s.%s (pk=%s)" % (self.index_name, self.doc_type, self.object_pk)
+
+    @classmethod
+    def forget(cls, index_name, doc_type, pks):
+        """
+        Drops fingerprints of documents written or removed without going through
+        a FingerprintStore, so they are sent again by the next fingerprinted run.
+        A doc_type of None drops them for every doc_type of the index.
+        Nothing is done unless ELASTICSEARCH_FINGERPRINTS is on
+        """
+        pks = [str(pk) for pk in pks]
+        if not pks or not conf.FINGERPRINTS:
+            return
+
+        entries = cls.objects.filter(index_name=index_name, object_pk__in=pks)
+        if doc_type is not None:
+            entries = entries.filter(doc_type=doc_type)
+        entries.delete()
+
+
+class IndexCheckpoint(models.Model):
+    """
+    Progress of an update_index run over an index and doc_type. Batches are
+    primary key ranges, last_pk is the end of the last batch which has been
+    sent, so an interrupted run can resume right after it
+    """
+    index_name = models.CharField(max_length=100)
+    doc_type = models.CharField(max_length=100)
+    target_index = models.CharField(max_length=150, blank=True, default='')
+    options = models.TextField()
+    last_pk = models.CharField(max_length=64, null=True, blank=True)
+    done = models.BooleanField(default=False)
+    modified = models.DateTimeField()
+
+    class Meta:
+        # A rebuild into a new index and updates of the live one keep apart
+        unique_together = (('index_name', 'doc_type', 'target_index'),)
+
+    def __unicode__(self):
+        return u"%s.%s (last_pk=%s)" % (self.index_name, self.doc_type, self.last_pk)
+
+    def advance(self, last_pk):
+        """
+        Records that every row up to last_pk has been sent
+        """
+        self.last_pk = str(last_pk)
+        self.modified = now()
+        IndexCheckpoint.objects.filter(pk=self.pk).update(last_pk=self.last_pk, modified=self.modified)
+
+    def finish(self):
+        self.done = True
+        self.modified = now()
+        IndexCheckpoint.objects.filter(pk=self.pk).update(done=True, modified=self.modified)
@@ -0,0 +1,166 @@
+from __future__ import print_function
+import logging
+import threading
+
+from six.moves import queue
+
+from django.db import connection, reset_queries
+
+from search.bulk import BulkIndexer
+from search.models import IndexFingerprint
+from search import conf
+
+
+log = logging.getLogger(__name__)
+
+# Marks the end of a stream of batches on a queue
+DONE = object()
+
+
+class IndexingPipeline(object):
+    """
+    Indexes querysets with the three steps of a batch running concurrently.
+    A reader thread fetches rows from the DB, serializer threads turn them into
+    bulk actions and sender threads write them to ES. Stages are connected by
+    bounded queues, so a slow stage holds the faster ones back instead of
+    letting batches pile up in memory.
+
+    Fingerprints kept under forget_index of the documents written are dropped.
+    """
+    def __init__(self, backend, index, doctype, remove=False, serializers=1, senders=2, queue_size=4,
+                 bulk_size=None, bulk_bytes=None, total=0, verbosity=1, forget_index=None):
+        self.backend = backend
+        self.index = index
+        self.doctype = doctype
+        self.remove = remove
+        self.serializers = max(int(serializers), 1)
+        self.senders = max(int(senders), 1)
+        self.bulk_size = bulk_size or conf.BULK_SIZE
+        self.bulk_bytes = bulk_bytes or conf.BULK_MAX_BYTES
+        self.total = total
+        self.verbosity = verbosity
+        self.forget_index = forget_index
+
+        self.fetch_queue = queue.Queue(maxsize=queue_size)
+        self.send_queue = queue.Queue(maxsize=queue_size)
+
+        self.errors = []
+        self.sent = 0
+        self._exceptions = []
+        self._abort = threading.Event()
+        self._lock = threading.Lock()
+        self._serializers_left = self.serializers
+
+    def run(self, batches):
+        """
+        Pushes every queryset of batches through the pipeline and blocks until
+        all of them have been written to ES
+        """
+        threads = [threading.Thread(target=self._stage, args=(self.read, batches))]
+        threads += [threading.Thread(target=self._stage, args=(self.serialize,)) for i in range(self.serializers)]
+        threads += [threading.Thread(target=self._stage, args=(self.send,)) for i in range(self.senders)]
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        if self._exceptions:
+            raise self._exceptions[0]
+
+        return self.errors
+
+    def _stage(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            log.exception("Indexing pipeline stage %s failed", func.__name__)
+            self._exceptions.append(e)
+            self._abort.set()
+        finally:
+            # Every thread gets its own DB connection, don't leave them open.
+            connection.close()
+
+    def _put(self, q, item):
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return DONE
+
+    def read(self, batches):
+        for qs in batches:
+            if not self._put(self.fetch_queue, list(qs)):
+                return
+            reset_queries()
+
+        for i in range(self.serializers):
+            self._put(self.fetch_queue, DONE)
+
+    def serialize(self):
+        active_field = self.index.active_field
+
+        while True:
+            items = self._get(self.fetch_queue)
+            if items is DONE:
+                break
+
+            actions = []
+            for item in items:
+                if getattr(item, active_field):
+                    actions.append(("index", item.pk, item.get_search_dict()))
+                elif self.remove:
+                    actions.append(("delete", item.pk, None))
+
+            if not self._put(self.send_queue, actions):
+                return
+
+        with self._lock:
+            self._serializers_left -= 1
+            last = self._serializers_left == 0
+
+        if last:
+            for i in range(self.senders):
+                self._put(self.send_queue, DONE)
+
+    def send(self):
+        bulk = BulkIndexer(self.backend, self.index.index_name, self.doctype, self.bulk_size, self.bulk_bytes)
+
+        while True:
+            actions = self._get(self.send_queue)
+            if actions is DONE:
+                break
+
+            for action, pk, body in actions:
+                if action == "index":
+                    bulk.index(pk, body)
+                else:
+                    bulk.remove(pk)
+
+            if self.forget_index is not None:
+                IndexFingerprint.forget(self.forget_index, self.doctype, [pk for action, pk, body in actions])
+
+            with self._lock:
+                self.sent += len(actions)
+                sent = self.sent
+
+            if self.verbosity >= 2:
+                print("  sent %d of %d." % (sent, self.total))
+
+        if not self._abort.is_set():
+            bulk.flush()
+
+        with self._lock:
+            self.errors.extend(bulk.errors)
@@ -0,0 +1,133 @@
+from __future__ import print_function
+import collections
+import json
+import time
+
+PHASES = ('db', 'serialize', 'encode', 'send')
+# Number of recent batches rolling percentiles are computed over
+WINDOW = 50
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile of values, None for no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class BatchTimer(object):
+    """
+    Times the phases of a single update_index batch. Encoding and sending
+    happen inside the BulkIndexer, which keeps its own timings
+    """
+    def __init__(self, doc_type, pid):
+        self.doc_type = doc_type
+        self.pid = pid
+        self.start = time.time()
+        self.db = 0.0
+
+    def fetched(self):
+        self.db = time.time() - self.start
+
+    def finish(self, docs, bulk):
+        total = time.time() - self.start
+        return {
+            'doc_type': self.doc_type,
+            'pid': self.pid,
+            'docs': docs,
+            'bytes': bulk.bytes_sent,
+            'db': self.db,
+            'serialize': max(0.0, total - self.db - bulk.encode_time - bulk.send_time),
+            'encode': bulk.encode_time,
+            'send': bulk.send_time,
+            'total': total,
+        }
+
+
+class Profiler(object):
+    """
+    Collects batch timings of an update_index run, prints rolling percentiles
+    while it goes and summarizes throughput per doc_type and worker process
+    """
+    def __init__(self, verbosity=1):
+        self.verbosity = verbosity
+        self.batches = []
+        self.recent = collections.defaultdict(lambda: collections.deque(maxlen=WINDOW))
+        self.wall = {}
+        self._started = {}
+
+    def start(self, doc_type):
+        self._started[doc_type] = time.time()
+
+    def finish(self, doc_type):
+        if doc_type in self._started:
+            self.wall[doc_type] = self.wall.get(doc_type, 0.0) + time.time() - self._started.pop(doc_type)
+
+    def add(self, batch):
+        self.batches.append(batch)
+        recent = self.recent[batch['doc_type']]
+        recent.append(batch)
+
+        if self.verbosity >= 1:
+            totals = [item['total'] for item in recent]
+            rates = [item['docs'] / item['total'] for item in recent if item['total']]
+            spent = dict((phase, sum(item[phase] for item in recent)) for phase in PHASES)
+            overall = sum(spent.values()) or 1.0
+
+            print("  profile %s: %.0f docs/s p50, batch p50 %.3fs p90 %.3fs p99 %.3fs, %s" % (
+                batch['doc_type'], percentile(rates, 0.5) or 0, percentile(totals, 0.5),
+                percentile(totals, 0.9), percentile(totals, 0.99),
+                " ".join("%s %d%%" % (phase, 100 * spent[phase] / overall) for phase in PHASES)))
+
+    def _throughput(self, batches):
+        busy = sum(batch['total'] for batch in batches)
+        docs = sum(batch['docs'] for batch in batches)
+        sent = sum(batch['bytes'] for batch in batches)
+
+        return {
+            'batches': len(batches),
+            'docs': docs,
+            'bytes': sent,
+            'docs_per_sec': docs / busy if busy else None,
+            'bytes_per_sec': sent / busy if busy else None,
+        }
+
+    def summary(self):
+        """
+        Returns totals of the run as a JSON serializable dictionary
+        """
+        by_doc_type = collections.defaultdict(list)
+        by_worker = collections.defaultdict(list)
+
+        for batch in self.batches:
+            by_doc_type[batch['doc_type']].append(batch)
+            by_worker[batch['pid']].append(batch)
+
+        doc_types = {}
+        for doc_type, batches in by_doc_type.items():
+            totals = [batch['total'] for batch in batches]
+            data = self._throughput(batches)
+            data['seconds'] = dict((phase, sum(batch[phase] for batch in batches)) for phase in PHASES)
+            data['batch_seconds'] = dict(('p%d' % (100 * fraction), percentile(totals, fraction))
+                                         for fraction in (0.5, 0.9, 0.99))
+            data['wall_seconds'] = self.wall.get(doc_type)
+            doc_types[doc_type] = data
+
+        workers = dict((str(pid), self._throughput(batches)) for pid, batches in by_worker.items())
+
+        return {'doc_types': doc_types, 'workers': workers}
+
+    def write(self, path=None):
+        """
+        Writes the summary as JSON to path, or prints it when there is none
+        """
+        data = json.dumps(self.summary(), indent=2, sort_keys=True)
+
+        if path is None:
+            print(data)
+        else:
+            with open(path, 'w') as output:
+                output.write(data)
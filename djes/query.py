@@ -1,9 +1,55 @@
+import base64
+import copy
+import json
+
+import six
+
+from search import conf
+from search.cache import get_query_cache, make_key, compact_response
+from search.constants import INVALID_CURSOR
+from search.instrumentation import measure
+
+# Parts of search responses read by Query, see conf.FILTER_PATH
+HITS_FILTER_PATH = ",".join(["took", "hits.total", "facets", "suggest"] +
+                            ["hits.hits.%s" % key for key in ('_type', '_id', '_score', '_source', 'fields', 'sort')])
+COUNT_FILTER_PATH = "took,hits.total"
+FACETS_FILTER_PATH = "took,hits.total,facets"
+
+
+def encode_cursor(sort_values):
+    """
+    Turns sort values of a hit into an opaque url safe cursor string
+    """
+    data = json.dumps(sort_values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Turns a cursor created by encode_cursor back into sort values
+    """
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+    except (TypeError, ValueError):
+        raise ValueError(INVALID_CURSOR)
+
+    if not isinstance(sort_values, list):
+        raise ValueError(INVALID_CURSOR)
+
+    return sort_values
+
 
 class Query(object):
     """
     Search Query maker. This class is responsible for converting
     params into appropriate dictionary to be later dumped as json
-    and passed to ES
+    and passed to ES.
+
+    Query nodes are persistent: every ``add_*`` method returns a new node and
+    leaves the one it was called on untouched. Parts which did not change are
+    shared between nodes, which is safe because they are never modified in
+    place. The compiled query DSL and its hash are memoized per node. Only the
+    execution state (limits, search_after and fetched results) changes on a node.
     """
     def __init__(self, index, doc_type, backend):
         self.index = index
@@ -17,10 +63,13 @@ class Query(object):
         self.function_score = None
         self.facets = None
         self.sort = None
+        self.source = None
         self.raw_query = None
         self.raw_params = None
         self.offset = 0
         self.size = 20
+        self.search_after = None
+        self.use_cache = True
 
         self.mlt_query = False
         self.mlt_doc = None
@@ -32,47 +81,65 @@ class Query(object):
         self._facet_counts = None
         self._suggestions = None
 
+        self._compiled = None
+        self._hash = None
+
+    def clone(self):
+        """
+        Returns a node with the same query and fresh execution state. Every part
+        of the query, including its compiled form, is shared with this node
+        """
+        clone = copy.copy(self)
+        clone.offset = 0
+        clone.size = 20
+        clone.search_after = None
+        clone._reset()
+        return clone
+
+    def _derive(self):
+        # A clone which is about to get a different query
+        clone = self.clone()
+        clone._compiled = None
+        clone._hash = None
+        return clone
+
+    def _filter_query(self, key, val):
+        if key == "ids":
+            return {"ids":{"values":val}}
+
+        key, operator = key.split("__") if len(key.split("__")) > 1 else [key, None]
+
+        if operator in ["gt", "gte", "lt", "lte"]:
+            return {"range":{key:{operator:val}}}
+
+        filter_type = "terms" if operator == "in" or type(val) == list else "term"
+        return {filter_type:{key:val}}
+
     def add_filter_and(self, kwargs):
         """
         Add AND Filter Query
         """
-        if self.filter_and_terms is None:
-            self.filter_and_terms = {"must":[]}
+        clone = self._derive()
+        must = list(self.filter_and_terms['must']) if self.filter_and_terms is not None else []
 
         for key, val in kwargs.items():
-            if key == "ids":
-                filter_query = {"ids":{"values":val}}
-            else:
-                key, operator = key.split("__") if len(key.split("__")) > 1 else [key, None]
-
-                if operator in ["gt", "gte", "lt", "lte"]:
-                    filter_query = {"range":{key:{operator:val}}}
-                else:
-                    filter_type = "terms" if operator == "in" or type(val) == list else "term"
-                    filter_query = {filter_type:{key:val}}
+            must.append(self._filter_query(key, val))
 
-            self.filter_and_terms['must'].append(filter_query)
+        clone.filter_and_terms = {"must":must}
+        return clone
 
     def add_filter_or(self, kwargs):
         """
         Add OR Filter Query
         """
-        if self.filter_or_terms is None:
-            self.filter_or_terms = {"should":[]}
+        clone = self._derive()
+        should = list(self.filter_or_terms['should']) if self.filter_or_terms is not None else []
 
         for key, val in kwargs.items():
-            if key == "ids":
-                filter_query = {"ids":{"values":val}}
-            else:
-                key, operator = key.split("__") if len(key.split("__")) > 1 else [key, None]
-
-                if operator in ["gt", "gte", "lt", "lte"]:
-                    filter_query = {"range":{key:{operator:val}}}
-                else:
-                    filter_type = "terms" if operator == "in" or type(val) == list else "term"
-                    filter_query = {filter_type:{key:val}}
+            should.append(self._filter_query(key, val))
 
-            self.filter_or_terms['should'].append(filter_query)
+        clone.filter_or_terms = {"should":should}
+        return clone
 
     def add_search_query(self, content, search_fields):
         """
@@ -83,39 +150,49 @@ class Query(object):
         else:
             search_query = {"match": {"_all": content}}
 
-        self.search_terms = search_query
+        clone = self._derive()
+        clone.search_terms = search_query
+        return clone
 
     def add_fields(self, fields):
         """
         Add list of fields to be sent back in response
         """
-        self.params['fields'] = fields
+        clone = self._derive()
+        clone.params = dict(self.params, fields=fields)
+        return clone
+
+    def add_source(self, source):
+        """
+        Set _source filtering of hits, either False or a dictionary of
+        include and exclude patterns
+        """
+        clone = self._derive()
+        clone.source = source
+        return clone
 
     def add_suggestion(self, suggest_text, suggest_field, suggest_mode, suggest_size):
         """
         Add suggestion query in search query to have suggestions returned as part of part
         search results
         """
-        self.params['suggest_text'] = suggest_text
-        self.params['suggest_field'] = suggest_field
-        self.params['suggest_mode'] = suggest_mode
-        self.params['suggest_size'] = suggest_size
+        clone = self._derive()
+        clone.params = dict(self.params, suggest_text=suggest_text, suggest_field=suggest_field,
+                            suggest_mode=suggest_mode, suggest_size=suggest_size)
+        return clone
 
     def add_term_facet(self, field, **kwargs):
         """
         Add terms facets to the query. If additional parameters are passed
         then they are attached to the terms query
         """
-        facets = {}
-        facets.update({field:{"terms":{"field":field}}})
+        terms = {"field":field}
+        terms.update(kwargs)
 
-        for key, val in kwargs.items():
-            facets[field]['terms'][key] = val
-
-        if self.facets is None:
-            self.facets = facets
-        else:
-            self.facets.update(facets)
+        clone = self._derive()
+        clone.facets = dict(self.facets or {})
+        clone.facets[field] = {"terms":terms}
+        return clone
 
     def add_term_facet_filter(self, field, **filter_query):
         """
@@ -123,20 +200,30 @@ class Query(object):
         in the list of facets then it is added
         """
         if self.facets is None or not self.facets.get(field):
-            self.add_term_facet(field)
+            clone = self.add_term_facet(field)
+        else:
+            clone = self._derive()
+            clone.facets = dict(self.facets)
 
-        facet = self.facets[field]
+        facet = dict(clone.facets[field])
+        facet_filter = list(facet['facet_filter']['and']) if 'facet_filter' in facet else []
 
         for key, val in filter_query.items():
-            field, operator = key.split("__") if len(key.split("__")) > 1 else [key, None]
+            filter_field, operator = key.split("__") if len(key.split("__")) > 1 else [key, None]
             filter_type = "terms" if operator == "in" or type(val) == list else "term"
-            facet.setdefault("facet_filter", {"and":[]})['and'].append({filter_type:{field:val}})
+            facet_filter.append({filter_type:{filter_field:val}})
+
+        facet['facet_filter'] = {"and":facet_filter}
+        clone.facets[field] = facet
+        return clone
 
     def add_function_score(self, query):
         """
         Add function score query to final query mainly to boost
         """
-        self.function_score = query
+        clone = self._derive()
+        clone.function_score = query
+        return clone
 
     def add_sort(self, args):
         """
@@ -150,30 +237,78 @@ class Query(object):
             else:
                 sort.append(field)
 
-        self.sort = sort
+        clone = self._derive()
+        clone.sort = sort
+        return clone
 
     def add_raw_query(self, query):
         """
         Set raw query
         """
-        self.raw_query = query
+        clone = self._derive()
+        clone.raw_query = query
+        return clone
 
     def add_raw_params(self, params):
         """
         Set raw params
         """
-        self.raw_params = params
+        clone = self._derive()
+        clone.raw_params = params
+        return clone
+
+    def set_search_after(self, sort_values):
+        """
+        Set sort values of the last hit of previous page. Results will start right
+        after it instead of at offset
+        """
+        self.search_after = sort_values
+
+    def cursor_sort(self):
+        """
+        Returns sort of the query with a unique tiebreaker appended, so that every
+        hit has a distinct position to continue from
+        """
+        sort = list(self.sort) if self.sort else [{"_score": "desc"}]
+
+        for field in sort:
+            name = field if not isinstance(field, dict) else list(field.keys())[0]
+            if name == conf.CURSOR_TIEBREAKER:
+                return sort
+
+        sort.append({conf.CURSOR_TIEBREAKER: "asc"})
+        return sort
 
     def mlt(self, docid, fields, **kwargs):
-        self.mlt_query = True
-        self.mlt_doc = docid
-        self.mlt_fields = fields
-        self.mlt_options = kwargs
+        clone = self._derive()
+        clone.mlt_query = True
+        clone.mlt_doc = docid
+        clone.mlt_fields = fields
+        clone.mlt_options = kwargs
+        return clone
 
     def build_query(self):
         """
         Combines all parameters relevant to Query DSL and builds the
-        final query to be sent to ES
+        final query to be sent to ES. The query is compiled once per node,
+        the returned dictionary must not be modified
+        """
+        if self._compiled is None:
+            self._compiled = self.compile()
+
+        if self.search_after is None:
+            return self._compiled
+
+        query = dict(self._compiled)
+        query['sort'] = self.cursor_sort()
+        if self.search_after:
+            query['search_after'] = self.search_after
+
+        return query
+
+    def compile(self):
+        """
+        Builds query DSL of this node
         """
         if self.raw_query is not None:
             return self.raw_query
@@ -207,11 +342,28 @@ class Query(object):
         if self.sort is not None:
             query['sort'] = self.sort
 
+        if self.source is not None:
+            query['_source'] = self.source
+
         if self.raw_params is not None:
             query.update(self.raw_params)
 
         return query
 
+    def get_hash(self):
+        """
+        Returns a stable hash of everything this node sends to ES apart from
+        limits, computed once per node
+        """
+        if self._hash is None:
+            if self._compiled is None:
+                self._compiled = self.compile()
+
+            extra = [self.params, self.mlt_query, self.mlt_doc, self.mlt_fields, self.mlt_options]
+            self._hash = make_key(self.index, self.doc_type, self._compiled, extra)
+
+        return self._hash
+
     def _reset(self):
         """
         Reset query, to make a fresh hit to ES
@@ -247,23 +399,20 @@ class Query(object):
     def get_count(self):
         """
         Return actual query results count. If query has not
-        run yet then this will run the query
+        run yet then this will run a count only query
         """
         if self._hit_count is None:
-            if self.mlt_query:
-                self.run_mlt()
-            else:
-                self.run()
+            self.run_count()
 
         return self._hit_count
 
     def get_facet_counts(self):
         """
-        Returns facet counts. It executes the query if the query has not
-        run yet
+        Returns facet counts. It executes a facet only query if the query
+        has not run yet
         """
         if self._facet_counts is None:
-            self.run()
+            self.run_facets()
 
         return self._facet_counts
 
@@ -281,30 +430,224 @@ class Query(object):
         """
         This method makes the actual hit to ES Search Api after computing all params
         """
-        final_query = self.build_query()
-        self.params['from_'] = self.offset
-        self.params['size'] = self.size
+        final_query, params = self.prepare()
+        self.set_response(self.search(final_query, params))
 
-        results = self.backend.search(index=self.index, doc_type=self.doc_type, body=final_query, **self.params)
+    def prepare(self):
+        """
+        Returns the final query and search params for current limits
+        """
+        params = dict(self.params)
+        params['from_'] = self.offset if self.search_after is None else 0
+        params['size'] = self.size
+        if conf.FILTER_PATH:
+            params['filter_path'] = HITS_FILTER_PATH
+        return self.build_query(), params
 
-        self._results = results['hits']['hits']
+    def set_response(self, results):
+        """
+        Stores results, count, facets and suggestions of a search response
+        """
+        # A filtered response has no hits key when nothing matched
+        self._results = results['hits'].get('hits', [])
         self._hit_count = results['hits']['total']
         self._facet_counts = self.process_facets(results.get('facets', {}))
         self._suggestions = self.process_suggestions(results.get('suggest', None))
 
-    def run_mlt(self):
+    def hit_free_params(self, facets=False):
         """
-        This method makes the actual hit to ES More Like This Api after computing all params
+        Returns search params for a query which fetches no hits, nor facets
+        unless asked for
+        """
+        params = dict((key, val) for key, val in self.params.items()
+                      if key not in ('from_', 'size', 'fields') and not key.startswith('suggest_'))
+        params['size'] = 0
+        if conf.FILTER_PATH:
+            params['filter_path'] = FACETS_FILTER_PATH if facets else COUNT_FILTER_PATH
+        return params
+
+    def mlt_params(self, **options):
+        """
+        Returns keyword arguments of a request to ES More Like This Api for this
+        query, apart from the body. options override those passed to mlt()
         """
-        self.mlt_options['search_from'] = self.offset
-        self.mlt_options['search_size'] = self.size
+        params = dict(self.mlt_options, **options)
+        params.update(index=self.index, doc_type=self.doc_type, id=self.mlt_doc, mlt_fields=self.mlt_fields)
+        return params
 
-        results = self.backend.mlt(index=self.index, doc_type=self.doc_type, id=self.mlt_doc, mlt_fields=self.mlt_fields, body=self.build_query(),**self.mlt_options)
+    def count_body(self):
+        """
+        Returns query DSL of a count only query, facets and sort are left out
+        """
+        body = dict(self.build_query())
+        body.pop('facets', None)
+        body.pop('sort', None)
+        return body
+
+    def facets_body(self):
+        """
+        Returns query DSL of a facet only query
+        """
+        body = dict(self.build_query())
+        body.pop('sort', None)
+        return body
+
+    def run_count(self):
+        """
+        Makes a hit to ES for the number of matching documents only. No hits
+        are fetched and facets are left out
+        """
+        body = self.count_body()
+
+        if self.mlt_query:
+            with measure("mlt", self.index, self.doc_type) as measurement:
+                results = self.backend.mlt(body=body, **self.mlt_params(search_from=0, search_size=0))
+                measurement.set_response(results)
+        else:
+            results = self.search(body, self.hit_free_params())
+
+        self._hit_count = results['hits']['total']
+
+    def run_facets(self):
+        """
+        Makes a hit to ES for facet counts, along with the count which comes for
+        free. No hits are fetched
+        """
+        results = self.search(self.facets_body(), self.hit_free_params(facets=True))
 
-        self._results = results['hits']['hits']
         self._hit_count = results['hits']['total']
         self._facet_counts = self.process_facets(results.get('facets', {}))
-        self._suggestions = self.process_suggestions(results.get('suggest', None))
+
+    def get_cache(self):
+        """
+        Returns the shared query cache to use for this query or None
+        """
+        # Only single index queries can be invalidated by writes to their index
+        if not self.use_cache or not isinstance(self.index, six.string_types):
+            return None
+        return get_query_cache()
+
+    def cache_key(self, body, params):
+        # The node hash stands in for its own compiled body, which saves
+        # serializing the whole body again
+        if body is self._compiled:
+            body = self.get_hash()
+        return make_key(self.index, self.doc_type, body, params)
+
+    def get_cached_response(self, body, params):
+        cache = self.get_cache()
+        if cache is None:
+            return None
+        return cache.get(self.index, self.cache_key(body, params))
+
+    def cache_response(self, body, params, results):
+        """
+        Stores a search response in the shared query cache and returns the
+        compact version of it which was stored
+        """
+        cache = self.get_cache()
+        if cache is None:
+            return results
+
+        results = compact_response(results)
+        cache.set(self.index, self.cache_key(body, params), results)
+        return results
+
+    def search(self, body, params):
+        """
+        Makes a hit to ES Search Api, going through the shared query cache when
+        it is enabled
+        """
+        with measure("search", self.index, self.doc_type) as measurement:
+            results = self.get_cached_response(body, params)
+
+            if results is not None:
+                measurement.set_response(results, "hit")
+            else:
+                results = self.backend.search(index=self.index, doc_type=self.doc_type, body=body, **params)
+                measurement.set_response(results, "miss" if self.get_cache() is not None else None)
+                results = self.cache_response(body, params, results)
+
+        return results
+
+    def get_msearch_request(self, body, params):
+        """
+        Returns header and body of this query for the Multi Search Api. Search
+        params which are url parameters of a regular search move into the body
+        """
+        header = {"index": self.index}
+        if self.doc_type is not None:
+            header["type"] = self.doc_type
+
+        body = dict(body)
+        body['from'] = params['from_']
+        body['size'] = params['size']
+
+        if params.get('fields'):
+            body['fields'] = list(params['fields'])
+
+        if params.get('suggest_field'):
+            body['suggest'] = {params['suggest_field']: {
+                "text": params['suggest_text'],
+                "term": {"field": params['suggest_field'], "suggest_mode": params['suggest_mode'], "size": params['suggest_size']}
+            }}
+
+        return [header, body]
+
+    def run_mlt(self):
+        """
+        This method makes the actual hit to ES More Like This Api after computing all params
+        """
+        body = self.build_query()
+
+        with measure("mlt", self.index, self.doc_type) as measurement:
+            results = self.backend.mlt(body=body, **self.mlt_params(search_from=self.offset, search_size=self.size))
+            measurement.set_response(results)
+
+        self.set_response(results)
+
+    def scan_request(self, chunk_size, scroll):
+        """
+        Returns name of the backend method and its keyword arguments for the
+        request which opens the scroll of scan
+        """
+        if self.mlt_query:
+            params = self.mlt_params(search_scroll=scroll, search_size=chunk_size)
+            params.pop('search_from', None)
+            return 'mlt', dict(params, body=self.build_query())
+
+        params = dict((key, val) for key, val in self.params.items()
+                      if key not in ('from_', 'size') and not key.startswith('suggest_'))
+        params.update(index=self.index, doc_type=self.doc_type, body=self.build_query(), scroll=scroll, size=chunk_size)
+        return 'search', params
+
+    def scan(self, chunk_size, scroll):
+        """
+        Generator which walks every hit of the query using the Scroll Api and yields
+        them a chunk at a time. Nothing is cached on the query. The scroll context is
+        cleared once iteration finishes or the generator is closed
+        """
+        method, params = self.scan_request(chunk_size, scroll)
+        with measure("scan", self.index, self.doc_type) as measurement:
+            results = getattr(self.backend, method)(**params)
+            measurement.set_response(results)
+
+        scroll_id = results.get('_scroll_id')
+
+        try:
+            while results['hits']['hits']:
+                yield results['hits']['hits']
+                with measure("scroll", self.index, self.doc_type) as measurement:
+                    results = self.backend.scroll(scroll_id=scroll_id, scroll=scroll)
+                    measurement.set_response(results)
+                scroll_id = results.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id is not None:
+                try:
+                    self.backend.clear_scroll(scroll_id=scroll_id)
+                except Exception:
+                    # Scroll contexts expire on their own after the timeout
+                    pass
 
     def has_run(self):
         """
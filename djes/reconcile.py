@@ -0,0 +1,134 @@
+import itertools
+
+import six
+
+from search.models import SQS
+from search import conf
+
+
+# A bitmap costs a bit for every possible key up to the highest one, a set
+# about 70 bytes per key. Once keys are on average further apart than this
+# many numbers, a set is the smaller of the two.
+MAX_BITMAP_GAP = 256
+# Bitmaps up to this size are always fine, small tables don't switch early
+MIN_BITMAP_BYTES = 1024 * 1024
+
+
+class PkSet(object):
+    """
+    Set of primary keys. Dense non negative integers are kept in a bitmap, one
+    bit per possible key, which holds tens of millions of keys in a few megabytes.
+    When the keys are too sparse for that, e.g. snowflake ids, the integers move
+    into a regular set, as does anything else, e.g. UUIDs. Those take memory
+    in proportion to the number of keys
+    """
+    def __init__(self):
+        self._bits = bytearray()
+        self._ints = set()
+        self._others = set()
+        self._count = 0
+
+    def __len__(self):
+        return self._count + len(self._ints) + len(self._others)
+
+    def add(self, pk):
+        if isinstance(pk, six.integer_types) and pk >= 0:
+            if self._bits is not None and not self._fits(pk):
+                self._drop_bitmap()
+
+            if self._bits is None:
+                self._ints.add(pk)
+                return
+
+            byte = pk >> 3
+            if byte >= len(self._bits):
+                # Grow geometrically, keys mostly arrive in ascending order
+                size = max(byte + 1, min(2 * len(self._bits), self._max_bytes()))
+                self._bits.extend(bytearray(size - len(self._bits)))
+
+            mask = 1 << (pk & 7)
+            if not self._bits[byte] & mask:
+                self._bits[byte] |= mask
+                self._count += 1
+        else:
+            self._others.add(six.text_type(pk))
+
+    def _max_bytes(self):
+        return max(MIN_BITMAP_BYTES, (self._count + 1) * MAX_BITMAP_GAP // 8)
+
+    def _fits(self, pk):
+        return (pk >> 3) < max(len(self._bits), self._max_bytes())
+
+    def _drop_bitmap(self):
+        # Moves the keys of the bitmap into the set of integers
+        for byte, bits in enumerate(self._bits):
+            if bits:
+                for bit in range(8):
+                    if bits & (1 << bit):
+                        self._ints.add((byte << 3) | bit)
+
+        self._bits = None
+        self._count = 0
+
+    def __contains__(self, doc_id):
+        """
+        Checks for a document id as returned by ES, i.e. a string
+        """
+        doc_id = six.text_type(doc_id)
+
+        try:
+            pk = int(doc_id)
+        except ValueError:
+            return doc_id in self._others
+
+        if pk < 0 or six.text_type(pk) != doc_id:
+            return doc_id in self._others
+
+        if self._bits is None:
+            return pk in self._ints
+
+        byte = pk >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & (1 << (pk & 7)))
+
+
+def queryset_pks(qs, chunk_size):
+    """
+    Yields every primary key of queryset in ascending order, walking it by
+    primary key ranges so memory stays bounded
+    """
+    pks = qs.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+
+    while True:
+        chunk = list((pks if last_pk is None else pks.filter(pk__gt=last_pk))[:chunk_size])
+        if not chunk:
+            return
+
+        for pk in chunk:
+            yield pk
+        last_pk = chunk[-1]
+
+
+def find_orphans(backend, index, doc_type, qs, chunk_size=None):
+    """
+    Yields ids of documents of index/doc_type which have no row in queryset.
+    The scroll over the index is opened before the DB is read, so rows created
+    while this runs can't be mistaken for orphans
+    """
+    chunk_size = chunk_size or conf.SCROLL_SIZE
+    sqs = SQS(index.index_name, doc_type, backend=backend).raw_params({"_source": False})
+    chunks = sqs.query.scan(chunk_size, conf.RECONCILE_SCROLL_TIMEOUT)
+
+    try:
+        first = next(chunks, [])
+
+        existing = PkSet()
+        for pk in queryset_pks(qs, chunk_size * 10):
+            existing.add(pk)
+
+        for hits in itertools.chain([first], chunks):
+            for hit in hits:
+                if hit['_id'] not in existing:
+                    yield hit['_id']
+    finally:
+        chunks.close()
@@ -0,0 +1,72 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Keys SearchResult puts in front of the document fields
+META_KEYS = ('index_name', 'doc_type', 'pk', 'score')
+
+
+def dumps(obj):
+    """
+    Encodes obj as JSON bytes with the fastest encoder installed. orjson and
+    ujson are used when available, the standard library otherwise
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+
+    if ujson is not None:
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    from search.models import SearchEncoder
+    return json.dumps(obj, cls=SearchEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def hit_to_json(index_name, hit):
+    """
+    Encodes a raw hit exactly like SearchEncoder encodes its SearchResult,
+    without building the result or copying the document
+    """
+    body = hit.get('fields') or hit.get('_source') or {}
+    meta = [index_name, hit['_type'], hit['_id'], hit.get('_score')]
+
+    if any(key in body for key in META_KEYS):
+        # Document fields shadowed by metadata have to be dropped, do it the slow way
+        data = dict(zip(META_KEYS, meta))
+        for key, val in body.items():
+            if key not in data:
+                data[key] = val
+        return dumps(data)
+
+    prefix = dumps(dict(zip(META_KEYS, meta)))
+    if not body:
+        return prefix
+
+    # Splice the encoded document into the encoded metadata object
+    return prefix[:-1] + b"," + dumps(body)[1:]
+
+
+def iter_json(chunks, encode):
+    """
+    Yields a JSON array a piece at a time, encoding every item of every
+    chunk with encode
+    """
+    yield b"["
+    first = True
+
+    for chunk in chunks:
+        for item in chunk:
+            if first:
+                first = False
+                yield encode(item)
+            else:
+                yield b"," + encode(item)
+
+    yield b"]"
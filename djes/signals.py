@@ -0,0 +1,46 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal
+
+# Sent whenever documents of an index are created, updated or removed
+index_updated = Signal(providing_args=["index_name"])
+
+# Sent after every request to ES while instrumentation is on, see search.instrumentation
+search_executed = Signal(providing_args=["record"])
+
+# Model class -> list of (index_name, doc_type) it is indexed as
+_realtime_models = {}
+
+
+def queue_for_indexing(sender, instance, **kwargs):
+    """
+    Puts a saved or deleted instance in the index outbox. Only the DB is
+    touched here, ES is written to when the outbox is drained
+    """
+    from search.models import IndexOutbox
+
+    for index_name, doc_type in _realtime_models.get(sender, []):
+        IndexOutbox.enqueue(index_name, doc_type, instance.pk)
+
+
+def setup_realtime_indexing(indexes=None):
+    """
+    Connects post_save and post_delete of the models behind every index in
+    ``conf.INDEXES`` (or the given index classes) to the index outbox. With
+    ``ELASTICSEARCH_REALTIME_INDEXING`` on, search.apps.SearchConfig calls it
+    once the app registry is ready. Before Django 1.7 call it yourself from a
+    module which is loaded at startup, such as urls.py
+    """
+    from search import conf
+
+    for index_class in (indexes or conf.INDEXES.values()):
+        index = index_class()
+
+        for doc_type in index.doc_types:
+            model = getattr(index, "%s_queryset" % doc_type)(start_date=None, end_date=None).model
+            entry = (index.index_name, doc_type)
+
+            if entry not in _realtime_models.setdefault(model, []):
+                _realtime_models[model].append(entry)
+
+            post_save.connect(queue_for_indexing, sender=model, dispatch_uid="djes_realtime_save")
+            post_delete.connect(queue_for_indexing, sender=model, dispatch_uid="djes_realtime_delete")
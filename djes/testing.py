@@ -0,0 +1,171 @@
+"""
+In-process stand-ins for ES and for indexed models, used by the tests and
+the benchmarks. They answer from synthetic data without a cluster or a DB.
+"""
+import json
+
+
+class FakeSearchBackend(object):
+    """
+    Answers search, scroll, msearch and mget requests from ``total`` hits. Every
+    hit has ``source`` as its document, or a title of its own if there is none.
+    With ``facet_terms``, every requested facet comes back with that many terms
+    """
+    def __init__(self, total=25, source=None, facet_terms=0):
+        self.source = source
+        self.facet_terms = facet_terms
+        self.hits = [self.hit(i) for i in range(total)]
+        self.calls = []
+        self.cleared = []
+        self._scrolls = {}
+
+    def hit(self, position):
+        source = dict(self.source) if self.source is not None else {"title": "item %d" % position}
+        return {"_index": "content", "_type": "item", "_id": str(position), "_score": 1.0, "_source": source}
+
+    def facets(self, body):
+        return dict((field, {"_type": "terms", "terms": [{"term": "term %d" % i, "count": self.facet_terms - i}
+                                                         for i in range(self.facet_terms)]})
+                    for field in (body or {}).get('facets', {}))
+
+    def response(self, body, hits):
+        response = {"took": 1, "hits": {"total": len(self.hits), "hits": hits}}
+        if self.facet_terms:
+            response["facets"] = self.facets(body)
+        return response
+
+    def search(self, index=None, doc_type=None, body=None, **params):
+        self.calls.append(("search", params))
+        size = params.get('size', 10)
+
+        if 'scroll' in params:
+            scroll_id = "scroll-%d" % len(self._scrolls)
+            self._scrolls[scroll_id] = (size, size)
+            return dict(self.response(body, self.hits[:size]), _scroll_id=scroll_id)
+
+        start = params.get('from_', 0)
+        return self.response(body, self.hits[start:start + size])
+
+    def mget(self, body, index=None, doc_type=None, **params):
+        self.calls.append(("mget", body["ids"]))
+        docs = dict((hit["_id"], hit) for hit in self.hits)
+        return {"docs": [dict(docs[doc_id], found=True) if doc_id in docs else
+                         {"_index": index, "_type": doc_type, "_id": doc_id, "found": False}
+                         for doc_id in body["ids"]]}
+
+    def msearch(self, body):
+        self.calls.append(("msearch", len(body) // 2))
+        responses = []
+
+        for header, query in zip(body[::2], body[1::2]):
+            start, size = query.get('from', 0), query.get('size', 10)
+            responses.append(self.response(query, self.hits[start:start + size]))
+
+        return {"responses": responses}
+
+    def scroll(self, scroll_id, scroll=None):
+        self.calls.append(("scroll", scroll_id))
+        size, position = self._scrolls[scroll_id]
+        self._scrolls[scroll_id] = (size, position + size)
+        return {"_scroll_id": scroll_id, "hits": {"total": len(self.hits), "hits": self.hits[position:position + size]}}
+
+    def clear_scroll(self, scroll_id):
+        self.cleared.append(scroll_id)
+
+
+class FakeBulkBackend(object):
+    """
+    Records bulk bodies and answers every action with the given status
+    """
+    def __init__(self, status=201):
+        self.status = status
+        self.bodies = []
+        self.deleted = []
+
+    def bulk(self, body):
+        self.bodies.append(body)
+        items = []
+        lines = iter(body.decode('utf-8').splitlines())
+
+        for line in lines:
+            line = json.loads(line)
+            for action in ("index", "delete"):
+                if action in line:
+                    items.append({action: {"_id": line[action]["_id"], "status": self.status}})
+
+            if "index" in line:
+                # Skip the document of the action
+                next(lines, None)
+
+        return {"took": 1, "items": items}
+
+    def delete(self, index, doc_type, doc_id):
+        self.deleted.append(doc_id)
+        return {"found": True}
+
+
+class FakeItem(object):
+    def __init__(self, pk, published=True, source=None):
+        self.pk = pk
+        self.published = published
+        self.source = source
+
+    def get_search_dict(self):
+        if self.source is not None:
+            return dict(self.source)
+        return {"title": "item %d" % self.pk}
+
+
+class FakeIndex(object):
+    index_name = "content"
+    active_field = "published"
+
+
+class FakeQuerySet(object):
+    """
+    Just enough of a queryset of FakeItems to be sliced and walked by primary
+    key the way update_index and reconcile do
+    """
+    def __init__(self, items, flat=False):
+        self.items = sorted(items, key=lambda item: item.pk)
+        self.flat = flat
+
+    def _rows(self, items, flat=None):
+        rows = FakeQuerySet([], self.flat if flat is None else flat)
+        rows.items = items
+        return rows
+
+    def all(self):
+        return self._rows(self.items)
+
+    def order_by(self, *fields):
+        return self
+
+    def values_list(self, *fields, **kwargs):
+        return self._rows(self.items, flat=True)
+
+    def filter(self, pk__gt=None, pk__lte=None):
+        # Checkpoints hand primary keys back as strings, like the ORM accepts
+        items = [item for item in self.items
+                 if (pk__gt is None or item.pk > type(item.pk)(pk__gt)) and
+                    (pk__lte is None or item.pk <= type(item.pk)(pk__lte))]
+        return self._rows(items)
+
+    def reverse(self):
+        return self._rows(self.items[::-1])
+
+    def count(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, k):
+        rows = self.items[k]
+        if not self.flat:
+            return rows
+        return [item.pk for item in rows] if isinstance(k, slice) else rows.pk
+
+
+def fake_rows(pks, source=None):
+    return FakeQuerySet([FakeItem(pk, source=source) for pk in pks])
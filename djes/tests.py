@@ -5,8 +5,42 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import json
+import sys
+from datetime import datetime
+from unittest import skipIf
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
 
+from elasticsearch import TransportError, NotFoundError, ConnectionError as ESConnectionError
+
+from search.bulk import BulkIndexer
+from search.testing import FakeSearchBackend, FakeBulkBackend, FakeItem, FakeIndex, FakeQuerySet, fake_rows
+from search.management.commands.update_index import do_update, keyset_ranges
+from search.management.commands.drain_index import drain
+from search.management.commands.rebuild_index import Command as RebuildCommand
+from search.pipeline import IndexingPipeline
+from search.reconcile import PkSet, find_orphans
+from search.fingerprints import FingerprintStore, fingerprint
+from search.profiling import Profiler, percentile
+from search.benchmarks import run_benchmarks, compare
+from search import connection
+from search import conf, instrumentation, signals
+from search.indexes import ContentIndex
+from search.query import decode_cursor
+from search.models import SQS, SearchEncoder, IndexOutbox, IndexCheckpoint, IndexFingerprint, msearch
+from search import models as models_module
+from search import cache as query_cache
+from search.cache import SparseResultCache, LocMemQueryCache
+from fq.curator.models import Item
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +48,1261 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class BulkIndexerTest(TestCase):
+    def test_flush_on_action_count(self):
+        backend = FakeBulkBackend()
+        bulk = BulkIndexer(backend, "content", "item", max_actions=2)
+
+        bulk.index(1, {"title": "one"})
+        self.assertEqual(len(backend.bodies), 0)
+        bulk.index(2, {"title": "two"})
+        self.assertEqual(len(backend.bodies), 1)
+        self.assertEqual(bulk.indexed, 2)
+        self.assertEqual(len(bulk), 0)
+
+    def test_flush_on_byte_size(self):
+        backend = FakeBulkBackend()
+        bulk = BulkIndexer(backend, "content", "item", max_actions=100, max_bytes=50)
+
+        bulk.index(1, {"title": "x" * 60})
+        self.assertEqual(len(backend.bodies), 1)
+
+    def test_errors_are_reported(self):
+        backend = FakeBulkBackend(status=400)
+
+        with BulkIndexer(backend, "content", "item") as bulk:
+            bulk.index(1, {"title": "one"})
+            bulk.remove(2)
+
+        self.assertEqual([(e[0], e[1]) for e in bulk.errors], [("index", 1), ("delete", 2)])
+
+    def test_missing_delete_is_not_an_error(self):
+        backend = FakeBulkBackend(status=404)
+
+        with BulkIndexer(backend, "content", "item") as bulk:
+            bulk.remove(2)
+
+        self.assertEqual(bulk.errors, [])
+        self.assertEqual(bulk.removed, 1)
+
+
+class IndexingPipelineTest(TestCase):
+    def test_all_batches_are_sent(self):
+        backend = FakeBulkBackend()
+        batches = [[FakeItem(pk) for pk in range(start, start + 10)] for start in range(0, 50, 10)]
+        batches[-1].append(FakeItem(99, published=False))
+
+        pipeline = IndexingPipeline(backend, FakeIndex(), "item", remove=True, serializers=2, senders=3,
+                                    queue_size=1, bulk_size=7)
+        errors = pipeline.run(iter(batches))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(pipeline.sent, 51)
+        self.assertEqual(sum(body.count(b'"index"') for body in backend.bodies), 50)
+        self.assertEqual(sum(body.count(b'"delete"') for body in backend.bodies), 1)
+
+    def test_written_documents_are_forgotten(self):
+        batches = [[FakeItem(pk) for pk in range(start, start + 10)] for start in range(0, 30, 10)]
+
+        # Sender threads would not see the in-memory test DB
+        with mock.patch('search.pipeline.IndexFingerprint.forget') as forget:
+            pipeline = IndexingPipeline(FakeBulkBackend(), FakeIndex(), "item", senders=2, forget_index="content")
+            pipeline.run(iter(batches))
+
+        self.assertEqual(set(call[0][:2] for call in forget.call_args_list), set([("content", "item")]))
+        self.assertEqual(sorted(pk for call in forget.call_args_list for pk in call[0][2]), list(range(30)))
+
+
+class CursorPageTest(TestCase):
+    def test_page_uses_search_after(self):
+        backend = FakeSearchBackend(total=25)
+        for position, hit in enumerate(backend.hits):
+            hit['sort'] = [1.0, hit['_id']]
+
+        calls = []
+        search = backend.search
+
+        def recording_search(index=None, doc_type=None, body=None, **params):
+            calls.append(body)
+            after = body.get('search_after')
+            if after is not None:
+                params['from_'] = [hit['sort'] for hit in backend.hits].index(after) + 1
+            return search(index=index, doc_type=doc_type, body=body, **params)
+
+        backend.search = recording_search
+        sqs = SQS("content", "item", backend=backend)
+
+        first, cursor = sqs.page(size=10)
+        second, cursor = sqs.page(cursor, size=10)
+        third, cursor = sqs.page(cursor, size=10)
+
+        self.assertEqual([result.pk for result in second], [str(i) for i in range(10, 20)])
+        self.assertEqual(len(third), 5)
+        self.assertEqual(cursor, None)
+        self.assertNotIn('search_after', calls[0])
+        self.assertEqual(calls[0]['sort'][-1], {"_id": "asc"})
+
+    def test_invalid_cursor(self):
+        sqs = SQS("content", "item", backend=FakeSearchBackend())
+        self.assertRaises(ValueError, sqs.page, "not a cursor!")
+
+    def test_mlt_is_rejected(self):
+        sqs = SQS("content", "item", backend=FakeSearchBackend()).mlt("1")
+        self.assertRaises(ValueError, sqs.page)
+
+    def test_page_leaves_results_alone(self):
+        backend = FakeSearchBackend(total=25)
+        for hit in backend.hits:
+            hit['sort'] = [1.0, hit['_id']]
+        sqs = SQS("content", "item", backend=backend)
+
+        self.assertEqual(len(sqs[:5]), 5)
+        query = sqs.query
+        sqs.page(size=10)
+
+        self.assertIs(sqs.query, query)
+        self.assertEqual(query.search_after, None)
+        self.assertEqual((query.offset, query.size), (0, 5))
+        self.assertEqual(len(query._results), 5)
+
+
+class SparseResultCacheTest(TestCase):
+    def test_segments_are_merged(self):
+        cache = SparseResultCache()
+        cache.add(20, list(range(20, 30)))
+        cache.add(0, list(range(0, 10)))
+
+        self.assertTrue(cache.is_cached(0, 10))
+        self.assertFalse(cache.is_cached(5, 15))
+        self.assertEqual(cache.slice(5, 15), list(range(5, 10)))
+
+        cache.add(8, list(range(8, 22)))
+
+        self.assertTrue(cache.is_cached(0, 30))
+        self.assertEqual(cache.slice(0), list(range(0, 30)))
+        self.assertEqual(len(cache), 30)
+
+    def test_missing_position(self):
+        cache = SparseResultCache()
+        cache.add(10, [10, 11])
+
+        self.assertEqual(cache.get(11), 11)
+        self.assertRaises(IndexError, cache.get, 12)
+        self.assertEqual(cache.slice(0, 5), [])
+
+    def test_sequential_pages_grow_one_segment(self):
+        cache = SparseResultCache()
+        cache.add(0, list(range(10)))
+        segment = cache._segments[0]
+
+        for start in range(10, 1000, 10):
+            cache.add(start, list(range(start, start + 10)))
+
+        # Pages are appended to the first segment instead of copying it
+        self.assertIs(cache._segments[0], segment)
+        self.assertEqual(segment, list(range(1000)))
+        self.assertEqual(cache._starts, [0])
+
+    def test_gap_is_filled_in_place(self):
+        cache = SparseResultCache()
+        cache.add(0, [0, 1])
+        cache.add(4, [4, 5])
+        segment = cache._segments[0]
+
+        cache.add(1, ["one", 2, 3])
+
+        self.assertIs(cache._segments[0], segment)
+        self.assertEqual(cache.slice(0), [0, "one", 2, 3, 4, 5])
+        self.assertEqual(cache._starts, [0])
+
+
+class SQSCacheTest(TestCase):
+    def test_getitem_and_iteration(self):
+        backend = FakeSearchBackend(total=25)
+        sqs = SQS("content", "item", backend=backend)
+
+        self.assertEqual([result.pk for result in sqs[20:30]], [str(i) for i in range(20, 25)])
+        self.assertEqual(sqs[3].pk, "3")
+        self.assertEqual([result.pk for result in sqs], [str(i) for i in range(25)])
+        self.assertEqual(len(sqs), 25)
+
+        searches = len(backend.calls)
+        list(sqs)
+        self.assertEqual(len(backend.calls), searches)
+
+
+class QueryCacheTest(TestCase):
+    def setUp(self):
+        query_cache._query_cache = LocMemQueryCache(max_entries=10)
+
+    def tearDown(self):
+        query_cache._query_cache = None
+
+    def test_repeated_query_is_served_from_cache(self):
+        backend = FakeSearchBackend(total=25)
+
+        first = SQS("content", "item", backend=backend).filter(brandid=1)
+        second = SQS("content", "item", backend=backend).filter(brandid=1)
+
+        self.assertEqual([r.pk for r in first[:10]], [r.pk for r in second[:10]])
+        self.assertEqual(len(backend.calls), 1)
+
+        SQS("content", "item", backend=backend).no_cache().filter(brandid=1)[:10]
+        self.assertEqual(len(backend.calls), 2)
+
+    def test_writes_invalidate_index(self):
+        backend = FakeSearchBackend(total=25)
+        backend.index = lambda *args: {"created": True}
+
+        SQS("content", "item", backend=backend)[:10]
+        SQS("content", "item", backend=backend).index(1, {"title": "one"})
+        SQS("content", "item", backend=backend)[:10]
+
+        self.assertEqual(len(backend.calls), 2)
+
+    def test_lru_eviction(self):
+        cache = LocMemQueryCache(max_entries=2)
+
+        for key in ("a", "b", "c"):
+            cache.set("content", key, {"key": key})
+
+        self.assertEqual(cache.get("content", "a"), None)
+        self.assertEqual(cache.get("content", "c"), {"key": "c"})
+
+
+class MultiSearchTest(TestCase):
+    def test_queries_share_one_round_trip(self):
+        backend = FakeSearchBackend(total=25)
+        main = SQS("content", "item", backend=backend).search("shoes")
+        sidebar = SQS("content", "item", backend=backend).filter(brandid=1).facet("brandid")
+
+        msearch([main, sidebar])
+
+        self.assertEqual(backend.calls, [("msearch", 2)])
+        self.assertEqual([r.pk for r in main[:10]], [str(i) for i in range(10)])
+        self.assertEqual(len(sidebar), 25)
+        self.assertEqual(sidebar.facet_counts(), {})
+        self.assertEqual(len(backend.calls), 1)
+
+
+class HitFreeQueryTest(TestCase):
+    def test_count_fetches_no_hits(self):
+        backend = FakeSearchBackend(total=25)
+        sqs = SQS("content", "item", backend=backend).facet("brandid").sort("-price")
+
+        self.assertEqual(sqs.count(), 25)
+        self.assertEqual(backend.calls, [("search", {"size": 0})])
+
+    def test_facet_counts_fetch_no_hits(self):
+        backend = FakeSearchBackend(total=25)
+        sqs = SQS("content", "item", backend=backend).only("title").facet("brandid")
+
+        self.assertEqual(sqs.facet_counts(), {})
+        self.assertEqual(len(sqs), 25)
+        self.assertEqual(backend.calls, [("search", {"size": 0})])
+
+
+class FakeAsyncBackend(object):
+    """
+    Wraps a fake backend so that every call returns an awaitable
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        import asyncio
+        method = getattr(self.backend, name)
+
+        def call(*args, **kwargs):
+            # Called from a coroutine, so this is the loop running the test
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(method(*args, **kwargs))
+            return future
+
+        return call
+
+
+@skipIf(sys.version_info < (3, 6), "AsyncSQS needs Python 3.6+")
+class AsyncSQSTest(TestCase):
+    def run_async(self, awaitable):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(awaitable)
+        finally:
+            loop.close()
+
+    def collect(self, async_iterator):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        items = []
+        try:
+            while True:
+                try:
+                    items.append(loop.run_until_complete(async_iterator.__anext__()))
+                except StopAsyncIteration:
+                    return items
+        finally:
+            loop.close()
+
+    def test_fetch_and_count(self):
+        from search.aio import AsyncSQS
+
+        backend = FakeSearchBackend(total=25)
+        sqs = AsyncSQS("content", "item", backend=FakeAsyncBackend(backend)).filter(brandid=1)
+
+        results = self.run_async(sqs.fetch(10, 20))
+
+        self.assertEqual([r.pk for r in results], [str(i) for i in range(10, 20)])
+        self.assertEqual(self.run_async(sqs.count()), 25)
+        self.assertEqual(len(backend.calls), 1)
+        self.assertRaises(TypeError, len, sqs)
+
+    def test_scan(self):
+        from search.aio import AsyncSQS
+
+        backend = FakeSearchBackend(total=25)
+        sqs = AsyncSQS("content", "item", backend=FakeAsyncBackend(backend))
+
+        results = self.collect(sqs.iterator(chunk_size=10))
+
+        self.assertEqual([result.pk for result in results], [str(i) for i in range(25)])
+        self.assertEqual(backend.cleared, ["scroll-0"])
+
+    def test_page(self):
+        from search.aio import AsyncSQS
+
+        backend = FakeSearchBackend(total=15)
+        for hit in backend.hits:
+            hit['sort'] = [1.0, hit['_id']]
+        sqs = AsyncSQS("content", "item", backend=FakeAsyncBackend(backend))
+
+        results, cursor = self.run_async(sqs.page(size=10))
+
+        self.assertEqual([r.pk for r in results], [str(i) for i in range(10)])
+        self.assertEqual(decode_cursor(cursor), [1.0, "9"])
+
+    def test_msearch(self):
+        from search.aio import AsyncSQS, msearch as async_msearch
+
+        backend = FakeSearchBackend(total=25)
+        sqs_list = [AsyncSQS("content", "item", backend=FakeAsyncBackend(backend)).no_cache().filter(brandid=i) for i in range(2)]
+
+        self.run_async(async_msearch(sqs_list, 0, 5))
+
+        self.assertEqual(backend.calls, [("msearch", 2)])
+        self.assertEqual([r.pk for r in self.run_async(sqs_list[1].fetch(0, 5))], [str(i) for i in range(5)])
+        self.assertRaises(TypeError, msearch, sqs_list)
+
+    def test_iter_json(self):
+        from search.aio import AsyncSQS
+
+        backend = FakeSearchBackend(total=25)
+        sqs = AsyncSQS("content", "item", backend=FakeAsyncBackend(backend)).values_list("pk", flat=True)
+
+        page = json.loads(b"".join(self.collect(sqs.iter_json(5, 7))).decode('utf-8'))
+        everything = json.loads(b"".join(self.collect(sqs.iter_json(chunk_size=10))).decode('utf-8'))
+
+        self.assertEqual(page, ["5", "6"])
+        self.assertEqual(everything, [str(i) for i in range(25)])
+
+    def test_get_many(self):
+        from search.aio import AsyncSQS
+
+        backend = FakeSearchBackend(total=5)
+        sqs = AsyncSQS("content", "item", backend=FakeAsyncBackend(backend)).no_cache()
+
+        results = self.run_async(sqs.get_many([3, 9, 1]))
+
+        self.assertEqual([r and r.pk for r in results], ["3", None, "1"])
+        self.assertEqual(backend.calls, [("mget", ["3", "9", "1"])])
+
+    def test_get_and_autocomplete_are_recorded(self):
+        from search.aio import AsyncSQS
+
+        backend = mock.Mock()
+        backend.get.return_value = {"_id": "1", "_source": {"title": "item 1"}, "found": True}
+        backend.suggest.return_value = {"suggest": [{"text": "it", "options": [{"text": "item 1"}]}]}
+        sqs = AsyncSQS("content", "item", backend=FakeAsyncBackend(backend))
+
+        with mock.patch.object(conf, 'INSTRUMENT', True):
+            instrumentation.reset_queries()
+            result = self.run_async(sqs.get(1))
+            suggestions = self.run_async(sqs.autocomplete("it", "title_suggest"))
+
+        self.assertEqual(result.pk, "1")
+        self.assertEqual(suggestions, backend.suggest.return_value)
+        self.assertEqual([query['operation'] for query in instrumentation.get_queries()], ["get", "suggest"])
+
+    def test_blocking_methods_are_refused(self):
+        from search.aio import AsyncSQS
+
+        sqs = AsyncSQS("content", "item", backend=FakeAsyncBackend(FakeSearchBackend()))
+
+        self.assertRaises(TypeError, sqs.load_models)
+        self.assertRaises(TypeError, sqs.bulk)
+        self.assertRaises(TypeError, sqs.index, 1, {})
+        self.assertRaises(TypeError, sqs.remove, 1)
+
+
+class ResultHydrationTest(TestCase):
+    def test_lazy_results(self):
+        import pickle
+
+        backend = FakeSearchBackend(total=5)
+        result = SQS("content", "item", backend=backend).lazy()[2]
+
+        self.assertEqual((result.pk, result.doc_type, result.title), ("2", "item", "item 2"))
+        self.assertIs(result._hit, backend.hits[2])
+        self.assertRaises(AttributeError, getattr, result, "missing")
+        self.assertFalse(hasattr(result, "__dict__"))
+        self.assertEqual(pickle.loads(pickle.dumps(result)).title, "item 2")
+        self.assertEqual(json.loads(json.dumps(result, cls=SearchEncoder))["title"], "item 2")
+
+    def test_values_list(self):
+        sqs = SQS("content", "item", backend=FakeSearchBackend(total=5))
+
+        self.assertEqual(sqs.values_list("pk", "title")[:2], [("0", "item 0"), ("1", "item 1")])
+        self.assertEqual(sqs.values_list("title", flat=True)[:2], ["item 0", "item 1"])
+        self.assertRaises(TypeError, sqs.values_list, "pk", "title", flat=True)
+
+
+class JSONStreamTest(TestCase):
+    def test_stream_matches_search_encoder(self):
+        backend = FakeSearchBackend(total=25)
+        sqs = SQS("content", "item", backend=backend)
+
+        streamed = json.loads(b"".join(sqs.iter_json()).decode('utf-8'))
+        encoded = json.loads(json.dumps(list(sqs), cls=SearchEncoder))
+
+        self.assertEqual(streamed, encoded)
+        self.assertEqual(backend.cleared, ["scroll-0"])
+
+    def test_page_and_values(self):
+        sqs = SQS("content", "item", backend=FakeSearchBackend(total=25))
+
+        page = json.loads(b"".join(sqs.iter_json(5, 7)).decode('utf-8'))
+        values = json.loads(b"".join(sqs.values_list("pk").iter_json(0, 2)).decode('utf-8'))
+
+        self.assertEqual([result["pk"] for result in page], ["5", "6"])
+        self.assertEqual(values, [["0"], ["1"]])
+
+    def test_page_leaves_results_alone(self):
+        sqs = SQS("content", "item", backend=FakeSearchBackend(total=25))
+        self.assertEqual(len(sqs[:3]), 3)
+        query = sqs.query
+
+        b"".join(sqs.iter_json(5, 7))
+
+        self.assertIs(sqs.query, query)
+        self.assertEqual((query.offset, query.size), (0, 3))
+        self.assertEqual(len(query._results), 3)
+
+
+class ImmutableQueryTest(TestCase):
+    def test_show_query_is_a_copy(self):
+        base = SQS("content", "item", backend=FakeSearchBackend()).filter(brandid=1)
+        clone = base.sort("title")
+
+        base.show_query()['filter']['bool']['must'].append({"term": {"storeid": 1}})
+
+        self.assertEqual(len(base.show_query()['filter']['bool']['must']), 1)
+        self.assertEqual(len(clone.show_query()['filter']['bool']['must']), 1)
+
+    def test_chaining_leaves_base_untouched(self):
+        base = SQS("content", "item", backend=FakeSearchBackend()).filter(brandid=1).facet("brandid")
+        before = json.dumps(base.show_query(), sort_keys=True)
+
+        narrowed = base.filter(storeid=2).facet_filter("brandid", storeid=2).sort("-price")
+
+        self.assertEqual(json.dumps(base.show_query(), sort_keys=True), before)
+        self.assertEqual(len(narrowed.show_query()['filter']['bool']['must']), 2)
+        self.assertIs(narrowed.query.search_terms, base.query.search_terms)
+
+    def test_compiled_query_and_hash_are_memoized(self):
+        backend = FakeSearchBackend()
+        first = SQS("content", "item", backend=backend).search("shoes").filter(brandid=1)
+        second = SQS("content", "item", backend=backend).search("shoes").filter(brandid=1)
+
+        self.assertIs(first.query.build_query(), first.query.build_query())
+        self.assertEqual(first.query.get_hash(), second.query.get_hash())
+        self.assertNotEqual(first.query.get_hash(), first.filter(brandid=2).query.get_hash())
+
+    def test_limits_do_not_leak_into_params(self):
+        backend = FakeSearchBackend(total=25)
+        sqs = SQS("content", "item", backend=backend)
+
+        sqs[10:20]
+
+        self.assertEqual(sqs.query.params, {})
+
+
+class ReconcileTest(TestCase):
+    def test_pk_set(self):
+        pks = PkSet()
+        for pk in (0, 7, 8, 1000000, "abc"):
+            pks.add(pk)
+
+        self.assertEqual(len(pks), 5)
+        for doc_id in ("0", "7", "8", "1000000", "abc"):
+            self.assertIn(doc_id, pks)
+        for doc_id in ("1", "9", "08", "999999", "-1", "abd"):
+            self.assertNotIn(doc_id, pks)
+
+    def test_sparse_keys_leave_the_bitmap(self):
+        pks = PkSet()
+        for pk in range(100):
+            pks.add(pk)
+        for pk in (10 ** 15, 10 ** 15 + 5, 2 ** 62):
+            pks.add(pk)
+
+        self.assertTrue(pks._bits is None)
+        self.assertEqual(len(pks), 103)
+        for doc_id in ("0", "99", str(10 ** 15), str(10 ** 15 + 5), str(2 ** 62)):
+            self.assertIn(doc_id, pks)
+        for doc_id in ("100", str(10 ** 15 + 1)):
+            self.assertNotIn(doc_id, pks)
+
+    def test_dense_keys_stay_in_the_bitmap(self):
+        pks = PkSet()
+        for pk in range(0, 10 ** 6, 3):
+            pks.add(pk)
+
+        self.assertTrue(pks._bits is not None)
+        self.assertTrue(len(pks._bits) < 2 * 10 ** 6 // 8)
+        self.assertIn("999999", pks)
+        self.assertNotIn("999998", pks)
+
+    def test_find_orphans(self):
+        backend = FakeSearchBackend(total=25)
+        rows = fake_rows([pk for pk in range(25) if pk % 10 != 3])
+
+        orphans = list(find_orphans(backend, FakeIndex(), "item", rows, chunk_size=4))
+
+        self.assertEqual(orphans, ["3", "13", "23"])
+        self.assertEqual(backend.cleared, ["scroll-0"])
+
+
+class KeysetRangesTest(TestCase):
+    def test_ranges_cover_every_row(self):
+        ranges = list(keyset_ranges(fake_rows(range(1, 11)), 4))
+
+        self.assertEqual(ranges, [(None, 4), (4, 8), (8, 10)])
+
+    def test_last_range_ends_on_full_batch(self):
+        self.assertEqual(list(keyset_ranges(fake_rows(range(1, 9)), 4)), [(None, 4), (4, 8)])
+
+    def test_empty_table(self):
+        self.assertEqual(list(keyset_ranges(fake_rows([]), 4)), [])
+
+    def test_gaps_between_pks(self):
+        ranges = list(keyset_ranges(fake_rows([2, 3, 7, 20, 21, 50]), 2))
+
+        self.assertEqual(ranges, [(None, 3), (3, 20), (20, 50)])
+
+    def test_start_after_pk(self):
+        self.assertEqual(list(keyset_ranges(fake_rows(range(1, 11)), 4, after_pk=5)), [(5, 9), (9, 10)])
+
+    def test_deleted_rows(self):
+        pks = [Item.objects.create(title="item %d" % i).pk for i in range(7)]
+        Item.objects.filter(pk__in=pks[1:3]).delete()
+
+        ranges = list(keyset_ranges(Item.objects.all(), 2))
+
+        self.assertEqual(ranges, [(None, pks[3]), (pks[3], pks[5]), (pks[5], pks[6])])
+
+
+class RowsIndex(FakeIndex):
+    doc_types = ["item"]
+
+    def item_queryset(self, start_date, end_date):
+        return fake_rows(range(1, 11))
+
+
+class CheckpointTest(TestCase):
+    def setUp(self):
+        self.backend = FakeBulkBackend()
+        patches = [
+            mock.patch('search.management.commands.update_index.get_backend', return_value=self.backend),
+            mock.patch.dict('search.management.commands.update_index.INDEXES', {'rows': RowsIndex}, clear=True),
+            # Interrupted runs get logged, keep that out of the test output
+            mock.patch('search.management.commands.update_index.logging'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def update(self, **options):
+        call_command('update_index', 'rows', batchsize=4, verbosity=0, **options)
+
+    def interrupted_update(self, **options):
+        # Dies right after the first batch went through
+        calls = []
+
+        def first_batch_only(*args, **kwargs):
+            if calls:
+                raise RuntimeError("killed")
+            calls.append(args)
+            return do_update(*args, **kwargs)
+
+        with mock.patch('search.management.commands.update_index.do_update', side_effect=first_batch_only):
+            self.assertRaises(RuntimeError, self.update, keyset=True, **options)
+
+    def sent_pks(self):
+        lines = [json.loads(line) for body in self.backend.bodies for line in body.decode('utf-8').splitlines()]
+        return [line["index"]["_id"] for line in lines if "index" in line]
+
+    def test_resume_continues_after_checkpoint(self):
+        self.interrupted_update()
+        self.assertEqual(IndexCheckpoint.objects.get(doc_type="item").last_pk, "4")
+
+        self.backend.bodies = []
+        self.update(resume=True)
+
+        self.assertEqual(self.sent_pks(), list(range(5, 11)))
+        self.assertFalse(IndexCheckpoint.objects.exists())
+
+    def test_resume_with_other_options_is_refused(self):
+        self.interrupted_update()
+
+        self.assertRaises(CommandError, self.update, resume=True, remove=True)
+
+    def test_failed_batch_holds_checkpoint(self):
+        def second_batch_fails(*args, **kwargs):
+            errors, timings = do_update(*args, **kwargs)
+            return (1 if len(self.backend.bodies) == 2 else errors), timings
+
+        with mock.patch('search.management.commands.update_index.do_update', side_effect=second_batch_fails):
+            self.update(keyset=True)
+
+        checkpoint = IndexCheckpoint.objects.get()
+        self.assertEqual((checkpoint.last_pk, checkpoint.done), ("4", False))
+
+        self.backend.bodies = []
+        self.update(resume=True)
+        self.assertEqual(self.sent_pks(), list(range(5, 11)))
+
+    def test_resume_keeps_the_window_of_age(self):
+        queryset = mock.patch.object(RowsIndex, 'item_queryset', autospec=True,
+                                     side_effect=lambda index, start_date, end_date: fake_rows(range(1, 11)))
+        with queryset as item_queryset:
+            self.interrupted_update(age=60)
+            self.update(resume=True, age=60)
+
+        started, resumed = [call[1] for call in item_queryset.call_args_list]
+        self.assertIsNotNone(started['start_date'])
+        self.assertEqual(resumed, started)
+
+    def test_rebuild_checkpoint_is_left_alone(self):
+        self.interrupted_update(target_index="content_20260101000000")
+        self.update(keyset=True)
+
+        checkpoint = IndexCheckpoint.objects.get()
+        self.assertEqual((checkpoint.target_index, checkpoint.last_pk), ("content_20260101000000", "4"))
+
+    def test_finished_checkpoints_can_be_kept(self):
+        self.update(keyset=True, target_index="content_20260101000000", keep_checkpoints=True)
+
+        self.assertTrue(IndexCheckpoint.objects.get().done)
+
+    def test_rebuild_fingerprints_stay_with_the_build(self):
+        with mock.patch.object(conf, 'FINGERPRINTS', True):
+            self.update(target_index="content_20260101000000", fingerprints=True)
+
+        self.assertEqual(set(IndexFingerprint.objects.values_list('index_name', flat=True)),
+                         set(["content_20260101000000"]))
+        self.assertEqual(IndexFingerprint.objects.count(), 10)
+
+
+class FakeIndicesClient(object):
+    """
+    Keeps indices with their aliases, enough for rebuild_index to swap and
+    clean up
+    """
+    def __init__(self, aliases):
+        self.aliases = dict((name, set(names)) for name, names in aliases.items())
+        self.deleted = []
+
+    def exists(self, index):
+        return index in self.aliases
+
+    def create(self, index, body):
+        self.aliases[index] = set()
+
+    def put_settings(self, index, body):
+        pass
+
+    def refresh(self, index):
+        pass
+
+    def get_alias(self, name):
+        indices = dict((index, {"aliases": {name: {}}}) for index, names in self.aliases.items() if name in names)
+        if not indices:
+            raise NotFoundError(404, "alias [%s] missing" % name)
+        return indices
+
+    def update_aliases(self, body):
+        for action in body["actions"]:
+            for kind, params in action.items():
+                names = self.aliases[params["index"]]
+                if kind == "add":
+                    names.add(params["alias"])
+                else:
+                    names.discard(params["alias"])
+
+    def delete(self, index):
+        del self.aliases[index]
+        self.deleted.append(index)
+
+
+class RebuildIndexTest(TestCase):
+    def command(self, aliases):
+        command = RebuildCommand()
+        command.backend = mock.Mock()
+        command.backend.indices = FakeIndicesClient(aliases)
+        return command
+
+    def rebuild(self, aliases, **options):
+        # Returns the command and the options of every update_index it ran
+        command = self.command(aliases)
+        with mock.patch('search.management.commands.rebuild_index.get_backend', return_value=command.backend), \
+                mock.patch('search.management.commands.rebuild_index.call_command') as update_index:
+            command.handle_label('content', verbosity=0, **options)
+        return command, [call[1] for call in update_index.call_args_list]
+
+    def checkpoint(self, target_index, done=True):
+        IndexCheckpoint.objects.create(index_name="content", doc_type="item", target_index=target_index,
+                                       options="{}", done=done, modified=datetime(2026, 1, 1))
+
+    def test_changes_during_the_build_are_caught_up(self):
+        command, (build, catch_up) = self.rebuild({"content_20260101000000": ["content"]})
+        new_index = build['target_index']
+
+        self.assertTrue(build['keep_checkpoints'])
+        self.assertEqual(catch_up['target_index'], new_index)
+        self.assertEqual(catch_up['start_date'], command.build_started(new_index).isoformat())
+        self.assertFalse(catch_up['keyset'])
+        self.assertEqual(command.backend.indices.aliases[new_index], set(["content"]))
+
+    def test_build_started_comes_from_the_name(self):
+        self.assertEqual(self.command({}).build_started("content_20260102030405"), datetime(2026, 1, 2, 3, 4, 5))
+
+    def test_build_dying_before_the_swap_is_resumed(self):
+        # update_index went through, the alias was never swapped
+        self.checkpoint("content_20260102000000")
+
+        command, (build, catch_up) = self.rebuild({"content_20260101000000": ["content"],
+                                                   "content_20260102000000": []}, resume=True)
+
+        self.assertEqual((build['target_index'], build['resume']), ("content_20260102000000", True))
+        self.assertEqual(catch_up['start_date'], "2026-01-02T00:00:00")
+        self.assertEqual(command.backend.indices.aliases["content_20260102000000"], set(["content"]))
+        self.assertFalse(IndexCheckpoint.objects.exists())
+
+    def test_failed_build_is_not_swapped(self):
+        self.checkpoint("content_20260102000000", done=False)
+
+        with self.assertRaises(CommandError):
+            self.rebuild({"content_20260101000000": ["content"], "content_20260102000000": []}, resume=True)
+
+    def test_alias_is_swapped_and_old_index_retired(self):
+        command = self.command({"content_20260101000000": ["content"], "content_20260102000000": []})
+
+        command.swap_alias("content", "content_20260102000000")
+
+        self.assertEqual(command.backend.indices.aliases, {
+            "content_20260101000000": set(["content_retired"]),
+            "content_20260102000000": set(["content"]),
+        })
+
+    def test_fingerprints_of_the_build_go_live(self):
+        command = self.command({"content_20260101000000": ["content"], "content_20260102000000": []})
+        IndexFingerprint.objects.create(index_name="content", doc_type="item", object_pk="1", fingerprint="old")
+        IndexFingerprint.objects.create(index_name="content_20260102000000", doc_type="item", object_pk="2",
+                                        fingerprint="new")
+
+        with mock.patch.object(conf, 'FINGERPRINTS', True):
+            command.swap_alias("content", "content_20260102000000")
+
+        self.assertEqual(list(IndexFingerprint.objects.values_list('index_name', 'object_pk', 'fingerprint')),
+                         [("content", "2", "new")])
+
+    def test_abandoned_build_does_not_count(self):
+        command = self.command({
+            "content_20260101000000": ["content_retired"],
+            "content_20260102000000": ["content"],
+            # Interrupted rebuild which never went live
+            "content_20260103000000": [],
+            "content_20260104000000": [],
+        })
+
+        command.swap_alias("content", "content_20260104000000")
+        command.remove_old_indices("content", "content_20260104000000", keep=1)
+
+        indices = command.backend.indices
+        self.assertEqual(indices.deleted, ["content_20260101000000"])
+        self.assertEqual(sorted(indices.aliases), ["content_20260102000000", "content_20260103000000",
+                                                   "content_20260104000000"])
+
+    def test_live_index_is_never_removed(self):
+        command = self.command({
+            "content_20260101000000": ["content", "content_retired"],
+            "content_20260102000000": ["content_retired"],
+            "content_20260103000000": ["content"],
+        })
+
+        command.remove_old_indices("content", "content_20260103000000", keep=0)
+
+        self.assertEqual(command.backend.indices.deleted, ["content_20260102000000"])
+
+
+class IndexOutboxTest(TestCase):
+    def test_repeated_changes_collapse(self):
+        IndexOutbox.enqueue("content", "item", 1)
+        IndexOutbox.enqueue("content", "item", 1)
+        IndexOutbox.enqueue("content", "spread", 1)
+
+        self.assertEqual(IndexOutbox.objects.count(), 2)
+
+
+class RealtimeIndexingTest(TestCase):
+    def tearDown(self):
+        for model in signals._realtime_models:
+            signals.post_save.disconnect(sender=model, dispatch_uid="djes_realtime_save")
+            signals.post_delete.disconnect(sender=model, dispatch_uid="djes_realtime_delete")
+        signals._realtime_models.clear()
+
+    def test_save_and_delete_are_queued(self):
+        signals.setup_realtime_indexing([ContentIndex])
+
+        item = Item.objects.create(title="one")
+        pk = item.pk
+        self.assertEqual(list(IndexOutbox.objects.values_list('index_name', 'doc_type', 'object_pk')),
+                         [("content", "item", str(pk))])
+
+        IndexOutbox.objects.all().delete()
+        item.delete()
+        self.assertEqual(list(IndexOutbox.objects.values_list('object_pk', flat=True)), [str(pk)])
+
+    def test_ready_follows_setting(self):
+        from django.apps import apps
+
+        with mock.patch.object(conf, 'REALTIME_INDEXING', False):
+            apps.get_app_config('search').ready()
+        Item.objects.create(title="one")
+        self.assertEqual(IndexOutbox.objects.count(), 0)
+
+        with mock.patch.object(conf, 'REALTIME_INDEXING', True):
+            apps.get_app_config('search').ready()
+        Item.objects.create(title="two")
+        self.assertEqual(IndexOutbox.objects.count(), 1)
+
+
+class DrainIndexTest(TestCase):
+    def enqueue(self, *pks):
+        for pk in pks:
+            IndexOutbox.enqueue("content", "item", pk)
+
+    def actions(self, backend):
+        actions = []
+        for body in backend.bodies:
+            for line in body.decode('utf-8').splitlines():
+                line = json.loads(line)
+                for action in ("index", "delete"):
+                    if action in line:
+                        actions.append((action, str(line[action]["_id"])))
+        return actions
+
+    def test_index_and_delete_entries(self):
+        kept = Item.objects.create(title="kept")
+        hidden = Item.objects.create(title="hidden", published=False)
+        backend = FakeBulkBackend()
+        self.enqueue(kept.pk, hidden.pk, 999)
+
+        self.assertEqual(drain(backend, verbosity=0), 3)
+
+        self.assertEqual(sorted(self.actions(backend)),
+                         sorted([("index", str(kept.pk)), ("delete", str(hidden.pk)), ("delete", "999")]))
+        self.assertEqual(IndexOutbox.objects.count(), 0)
+
+    def test_failed_entries_are_retried(self):
+        item = Item.objects.create(title="one")
+        self.enqueue(item.pk)
+
+        self.assertEqual(drain(FakeBulkBackend(status=400), verbosity=0), 0)
+        self.assertEqual(IndexOutbox.objects.count(), 1)
+
+        backend = FakeBulkBackend()
+        self.assertEqual(drain(backend, verbosity=0), 1)
+        self.assertEqual(self.actions(backend), [("index", str(item.pk))])
+        self.assertEqual(IndexOutbox.objects.count(), 0)
+
+    def test_batch_size_limits_entries(self):
+        self.enqueue(1, 2, 3)
+
+        self.assertEqual(drain(FakeBulkBackend(), batch_size=2, verbosity=0), 2)
+        self.assertEqual(IndexOutbox.objects.count(), 1)
+
+
+class FingerprintTest(TestCase):
+    def setUp(self):
+        self.fingerprints = conf.FINGERPRINTS
+        conf.FINGERPRINTS = True
+
+    def tearDown(self):
+        conf.FINGERPRINTS = self.fingerprints
+
+    def test_fingerprint_ignores_key_order(self):
+        self.assertEqual(fingerprint({"a": 1, "b": [1, 2]}), fingerprint({"b": [1, 2], "a": 1}))
+        self.assertNotEqual(fingerprint({"a": 1}), fingerprint({"a": 2}))
+
+    def test_unchanged_documents_are_skipped(self):
+        items = [FakeItem(1), FakeItem(2)]
+        store = FingerprintStore("content", "item")
+
+        bulk = BulkIndexer(FakeBulkBackend(), "content", "item")
+        self.assertEqual(store.update(bulk, items, "published"), 0)
+        self.assertEqual(bulk.indexed, 2)
+
+        bulk = BulkIndexer(FakeBulkBackend(), "content", "item")
+        self.assertEqual(store.update(bulk, items, "published"), 2)
+        self.assertEqual(bulk.indexed, 0)
+
+    def test_deleted_document_is_sent_again(self):
+        items = [FakeItem(1), FakeItem(2)]
+        store = FingerprintStore("content", "item")
+        backend = FakeBulkBackend()
+
+        store.update(BulkIndexer(backend, "content", "item"), items, "published")
+        SQS("content", "item", backend=backend).remove(1)
+
+        bulk = BulkIndexer(backend, "content", "item")
+        self.assertEqual(store.update(bulk, items, "published"), 1)
+        self.assertEqual(bulk.indexed, 1)
+
+    def test_unpublished_document_is_sent_again(self):
+        items = [FakeItem(1)]
+        store = FingerprintStore("content", "item")
+        store.update(BulkIndexer(FakeBulkBackend(), "content", "item"), items, "published")
+
+        # A run without fingerprints removes it, then it comes back unchanged
+        do_update(FakeBulkBackend(), FakeIndex(), "item", FakeQuerySet([FakeItem(1, published=False)]),
+                  0, 1, 1, True, verbosity=0, forget_index="content")
+
+        bulk = BulkIndexer(FakeBulkBackend(), "content", "item")
+        self.assertEqual(store.update(bulk, items, "published"), 0)
+        self.assertEqual(bulk.indexed, 1)
+
+    def test_force_sends_everything(self):
+        store = FingerprintStore("content", "item", force=True)
+        changed = store.changed({1: {"title": "one"}})
+
+        self.assertEqual(changed, {1: ({"title": "one"}, fingerprint({"title": "one"}))})
+
+    def test_writes_leave_fingerprints_alone_when_off(self):
+        store = FingerprintStore("content", "item")
+        store.record({1: fingerprint({"title": "item 1"})})
+        conf.FINGERPRINTS = False
+
+        with self.assertNumQueries(0):
+            SQS("content", "item", backend=FakeBulkBackend()).remove(1)
+        self.assertEqual(IndexFingerprint.objects.count(), 1)
+
+        with self.assertRaises(CommandError):
+            call_command('update_index', 'content', fingerprints=True, verbosity=0)
+
+
+class ConnectionTest(TestCase):
+    def tearDown(self):
+        connection.reset_backend()
+
+    def test_client_is_shared_within_process(self):
+        self.assertIs(connection.get_backend(), connection.get_backend())
+
+    def test_forked_process_gets_its_own_client(self):
+        backend = connection.get_backend()
+
+        with mock.patch('search.connection.os.getpid', return_value=connection.os.getpid() + 1):
+            self.assertIsNot(connection.get_backend(), backend)
+
+
+class SerializingBackend(object):
+    """
+    Passes search bodies through the serializer of the ES client, like its
+    transport does
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.serializer = instrumentation.InstrumentedSerializer()
+
+    def search(self, body=None, **params):
+        self.serializer.dumps(body)
+        return self.serializer.loads(json.dumps(self.backend.search(body=body, **params)))
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        self.instrument = conf.INSTRUMENT
+        conf.INSTRUMENT = True
+        instrumentation.reset_queries()
+
+    def tearDown(self):
+        conf.INSTRUMENT = self.instrument
+
+    def test_searches_are_recorded(self):
+        sqs = SQS("content", "item", backend=SerializingBackend(FakeSearchBackend(total=25)))
+        list(sqs[:10])
+
+        queries = instrumentation.get_queries()
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(queries[0]['operation'], "search")
+        self.assertEqual(queries[0]['hits'], 25)
+        self.assertEqual(queries[0]['request_size'], len(json.dumps(sqs.query.build_query())))
+        self.assertTrue(queries[0]['response_size'] > 0)
+
+    def test_cached_responses_have_no_size(self):
+        query_cache._query_cache = LocMemQueryCache(max_entries=10)
+        try:
+            backend = SerializingBackend(FakeSearchBackend(total=25))
+            list(SQS("content", "item", backend=backend)[:10])
+            list(SQS("content", "item", backend=backend)[:10])
+        finally:
+            query_cache._query_cache = None
+
+        queries = instrumentation.get_queries()
+        self.assertEqual([query['cache'] for query in queries], ["miss", "hit"])
+        self.assertEqual((queries[1]['request_size'], queries[1]['response_size']), (None, None))
+
+    def test_scrolls_are_recorded(self):
+        sqs = SQS("content", "item", backend=FakeSearchBackend(total=25))
+        list(sqs.iterator(chunk_size=10))
+
+        operations = [query['operation'] for query in instrumentation.get_queries()]
+        self.assertEqual(operations, ["scan", "scroll", "scroll", "scroll"])
+
+    @skipIf(instrumentation.ContextVar is None, "Needs contextvars")
+    def test_contexts_have_their_own_log(self):
+        import contextvars
+
+        def run(requests):
+            instrumentation.reset_queries()
+            for i in range(requests):
+                list(SQS("content", "item", backend=FakeSearchBackend()).no_cache()[:10])
+            return instrumentation.get_queries()
+
+        first, second = contextvars.copy_context(), contextvars.copy_context()
+        self.assertEqual(len(first.run(run, 1)), 1)
+        self.assertEqual(len(second.run(run, 2)), 2)
+        self.assertEqual(len(first.run(instrumentation.get_queries)), 1)
+
+    def test_nothing_is_recorded_when_off(self):
+        conf.INSTRUMENT = False
+        list(SQS("content", "item", backend=FakeSearchBackend(total=25))[:10])
+
+        self.assertEqual(instrumentation.get_queries(), [])
+
+
+class ProfilerTest(TestCase):
+    def batch(self, doc_type, pid, total):
+        return {'doc_type': doc_type, 'pid': pid, 'docs': 100, 'bytes': 1000, 'db': total / 4,
+                'serialize': total / 4, 'encode': total / 4, 'send': total / 4, 'total': total}
+
+    def test_percentile(self):
+        self.assertEqual(percentile([3, 1, 2], 0.5), 2)
+        self.assertEqual(percentile(range(1, 101), 0.99), 99)
+        self.assertEqual(percentile([], 0.5), None)
+
+    def test_summary(self):
+        profiler = Profiler(verbosity=0)
+        profiler.add(self.batch("item", 1, 1.0))
+        profiler.add(self.batch("item", 2, 3.0))
+        profiler.add(self.batch("spread", 1, 2.0))
+
+        summary = json.loads(json.dumps(profiler.summary()))
+
+        self.assertEqual(summary['doc_types']['item']['docs'], 200)
+        self.assertEqual(summary['doc_types']['item']['docs_per_sec'], 50.0)
+        self.assertEqual(summary['doc_types']['item']['seconds']['send'], 1.0)
+        self.assertEqual(summary['workers']['1']['batches'], 2)
+
+    def test_bulk_indexer_counts_bytes(self):
+        with BulkIndexer(FakeBulkBackend(), "content", "item") as bulk:
+            bulk.index(1, {"title": "one"})
+
+        self.assertEqual(bulk.bytes_sent, len(bulk.backend.bodies[0]))
+
+
+class BenchmarkTest(TestCase):
+    def test_every_benchmark_runs(self):
+        results = run_benchmarks(hits=10, batch_size=20, min_time=0)
+
+        self.assertEqual(sorted(results), ["build_query", "paging", "post_process_results", "process_facets",
+                                           "search_encoder", "update_batch"])
+        self.assertEqual(compare({"paging": {"ops_per_sec": 150.0}}, {"paging": {"ops_per_sec": 100.0}}),
+                         {"paging": 0.5})
+
+    def test_db_is_left_alone(self):
+        IndexFingerprint.objects.create(index_name="content", doc_type="item", object_pk="1", fingerprint="x")
+
+        with mock.patch.object(conf, 'FINGERPRINTS', True), self.assertNumQueries(0):
+            run_benchmarks(hits=10, batch_size=20, min_time=0)
+
+        self.assertEqual(IndexFingerprint.objects.count(), 1)
+
+
+class FakeModelQuerySet(object):
+    """
+    Answers in_bulk for rows with even primary keys
+    """
+    def __init__(self, doc_type, lookups):
+        self.doc_type = doc_type
+        self.lookups = lookups
+
+    def select_related(self, *fields):
+        return self
+
+    def in_bulk(self, pks):
+        self.lookups.append((self.doc_type, list(pks)))
+        return dict((int(pk), "%s %s" % (self.doc_type, pk)) for pk in pks if int(pk) % 2 == 0)
+
+
+class ModelLoadingTest(TestCase):
+    def setUp(self):
+        self.lookups = []
+        self.get_model_queryset = models_module.get_model_queryset
+        models_module.get_model_queryset = lambda index_name, doc_type: FakeModelQuerySet(doc_type, self.lookups)
+
+    def tearDown(self):
+        models_module.get_model_queryset = self.get_model_queryset
+
+    def test_one_lookup_per_page(self):
+        sqs = SQS("content", "item", backend=FakeSearchBackend(total=25)).load_models(select_related=["store"])
+        results = sqs[:10]
+
+        self.assertEqual(self.lookups, [("item", [str(i) for i in range(10)])])
+        self.assertEqual([result.model_object for result in results[:3]], ["item 0", None, "item 2"])
+        self.assertFalse('_object' in json.loads(json.dumps(results[0], cls=SearchEncoder)))
+
+    def test_lazy_results(self):
+        results = SQS("content", "item", backend=FakeSearchBackend(total=25)).lazy().load_models()[:2]
+
+        self.assertEqual([result.model_object for result in results], ["item 0", None])
+
+    def test_object_field_is_readable(self):
+        backend = FakeSearchBackend(total=2, source={"object": "a field"})
+
+        for sqs in (SQS("content", "item", backend=backend), SQS("content", "item", backend=backend).lazy()):
+            result = sqs.load_models()[0]
+            self.assertEqual((result.object, result.model_object), ("a field", "item 0"))
+
+
+class GetManyTest(TestCase):
+    def tearDown(self):
+        query_cache._query_cache = None
+
+    def test_results_follow_ids(self):
+        backend = FakeSearchBackend(total=5)
+        results = SQS("content", "item", backend=backend).get_many([3, "missing", 1, 3])
+
+        self.assertEqual([result and result.pk for result in results], ["3", None, "1", "3"])
+        self.assertEqual(backend.calls, [("mget", ["3", "missing", "1"])])
+
+    def test_read_through_cache(self):
+        query_cache._query_cache = LocMemQueryCache(max_entries=10)
+        backend = FakeSearchBackend(total=5)
+
+        SQS("content", "item", backend=backend).get_many([1, 2])
+        results = SQS("content", "item", backend=backend).get_many([2, 1, 4])
+
+        self.assertEqual([result.pk for result in results], ["2", "1", "4"])
+        self.assertEqual(backend.calls, [("mget", ["1", "2"]), ("mget", ["4"])])
+
+    def test_get_missing_and_unreachable(self):
+        backend = mock.Mock()
+        sqs = SQS("content", "item", backend=backend)
+
+        backend.get.side_effect = NotFoundError(404, "not found")
+        self.assertEqual(sqs.get(1), None)
+
+        backend.get.side_effect = ESConnectionError("N/A", "connection refused", None)
+        self.assertRaises(ESConnectionError, sqs.get, 1)
+
+    def test_failed_documents_raise_and_are_not_cached(self):
+        query_cache._query_cache = LocMemQueryCache(max_entries=10)
+        backend = FakeSearchBackend(total=5)
+        mget = backend.mget
+
+        def failing_mget(body, **kwargs):
+            response = mget(body, **kwargs)
+            response["docs"][0] = {"_index": "content", "_type": "item", "_id": body["ids"][0],
+                                   "error": "NoShardAvailableActionException"}
+            return response
+
+        backend.mget = failing_mget
+        self.assertRaises(TransportError, SQS("content", "item", backend=backend).get_many, [1, 2])
+
+        backend.mget = mget
+        results = SQS("content", "item", backend=backend).get_many([1, 2])
+
+        self.assertEqual([result.pk for result in results], ["1", "2"])
+        self.assertEqual(backend.calls[-1], ("mget", ["1"]))
+
+
+class SourceFilteringTest(TestCase):
+    def setUp(self):
+        self.filter_path = conf.FILTER_PATH
+
+    def tearDown(self):
+        conf.FILTER_PATH = self.filter_path
+
+    def test_source_include_and_exclude(self):
+        sqs = SQS("content", "item", backend=FakeSearchBackend()).source(include=["title*"], exclude=["title_raw"])
+
+        self.assertEqual(sqs.show_query()['_source'], {"include": ["title*"], "exclude": ["title_raw"]})
+
+    def test_values_list_restricts_source(self):
+        sqs = SQS("content", "item", backend=FakeSearchBackend())
+
+        self.assertEqual(sqs.values_list("pk", "title").show_query()['_source'], {"include": ["title"]})
+        self.assertEqual(sqs.values_list("pk", flat=True).show_query()['_source'], False)
+        self.assertEqual(sqs.only("title").values_list("title").show_query().get('_source'), None)
+
+    def test_filter_path_follows_what_is_read(self):
+        conf.FILTER_PATH = True
+        backend = FakeSearchBackend(total=25)
+        sqs = SQS("content", "item", backend=backend)
+
+        list(sqs[:10])
+        sqs.no_cache().count()
+
+        self.assertTrue("hits.hits._source" in backend.calls[0][1]['filter_path'])
+        self.assertEqual(backend.calls[1][1]['filter_path'], "took,hits.total")
+
+    def test_filtered_response_without_hits(self):
+        query = SQS("content", "item", backend=FakeSearchBackend()).query
+        query.set_response({"hits": {"total": 0}})
+
+        self.assertEqual(query._results, [])
+
+
+class ScanTest(TestCase):
+    def test_iterator_walks_all_hits(self):
+        backend = FakeSearchBackend(total=25)
+        sqs = SQS("content", "item", backend=backend)
+
+        results = list(sqs.iterator(chunk_size=10))
+
+        self.assertEqual([result.pk for result in results], [str(i) for i in range(25)])
+        self.assertEqual(len(sqs._result_cache), 0)
+        self.assertEqual(backend.cleared, ["scroll-0"])
+
+    def test_abandoned_scan_clears_scroll(self):
+        backend = FakeSearchBackend(total=25)
+        results = SQS("content", "item", backend=backend).iterator(chunk_size=10)
+
+        next(results)
+        results.close()
+
+        self.assertEqual(backend.cleared, ["scroll-0"])